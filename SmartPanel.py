@@ -6,26 +6,30 @@ import asyncio
 # Author: Stefan Haun <tux@netz39.de>
 import signal
 import sys
+import time
 
-import configparser
+from startup import STARTUP
 
+from kivy import Logger
 from kivy.app import App
+from kivy.clock import Clock
 from kivy.config import Config
+from kivy.core.window import Window
 from kivy.lang import Builder
-from kivy.properties import ObjectProperty, StringProperty
+from kivy.properties import BooleanProperty, ObjectProperty, StringProperty
 from kivy.uix.relativelayout import RelativeLayout
 
-from shelly import ShellyButton
-from thing import Thing, WifiRepeater
+from metrics import REGISTRY, MetricsServer
+from settings import ConfigError, load_settings
 
-Builder.load_string('''
+# Only the widgets for the first frame are declared here,
+# all others are imported and built once the first frame is shown.
+# Compiled in build(), after the configuration has been parsed.
+KV = '''
 #:import BacklightControl backlight.BacklightControl
 #:import MqttClient mqtt.MqttClient
+#:import PerfOverlay overlay.PerfOverlay
 #:import ClockWidget clock.ClockWidget
-#:import EnvironmentWidget environment.EnvironmentWidget
-#:import FavButtonWidget player.FavButtonWidget
-#:import PlayerWidget player.PlayerWidget
-#:import ShellyButton shelly.ShellyButton
 
 <SmartPanelWidget>:
     BacklightControl:
@@ -37,28 +41,20 @@ Builder.load_string('''
         id: mqtt
         cfg: root.cfg
         pos: [800-32, 460-48]
+        on_long_press: overlay.visible = not overlay.visible
 
     ClockWidget:
+        id: clock
         pos: [0, 200]
         cfg: root.cfg
         basepath: root.IMGDIR
         touch_cb: None
-        
-    EnvironmentWidget:
-        pos: [330, 200]
-        cfg: root.cfg
-        mqtt: root.mqtt
-        
-    PlayerWidget:        
-        pos: [330, 0]
-        cfg: root.cfg
-        mqtt: root.mqtt
 
-    FavButtonWidget:        
-        pos: [700, 200]
+    PerfOverlay:
+        id: overlay
         cfg: root.cfg
-        mqtt: root.mqtt
-''')
+        pos: [800-32-140, 460-80]
+'''
 
 
 class SmartPanelWidget(RelativeLayout):
@@ -66,6 +62,8 @@ class SmartPanelWidget(RelativeLayout):
     mqtt = ObjectProperty()
 
     IMGDIR = StringProperty("resources/nixie/")
+    # set once the widgets after the first frame are built
+    built = BooleanProperty(False)
 
     def __init__(self, cfg, **kwargs):
         super(SmartPanelWidget, self).__init__(**kwargs)
@@ -73,30 +71,83 @@ class SmartPanelWidget(RelativeLayout):
         self.cfg = cfg
         
         self.mqtt = self.ids.mqtt
+        self.mqtt.bind(status=self._on_mqtt_status)
+
+        self.wifi_repeater = None
+        self.pager = None
+        self.alarms = None
+
+        Window.bind(on_flip=self._on_first_frame)
+
+    def _on_first_frame(self, *_largs):
+        Window.unbind(on_flip=self._on_first_frame)
+        STARTUP.mark("first_frame")
+
+        Clock.schedule_once(lambda dt: self._build_late(), 0)
+
+    def _on_mqtt_status(self, _instance, status):
+        if status == "connected":
+            STARTUP.mark("mqtt_connected")
+
+    def _add_late(self, widget):
+        widget.cfg = self.cfg
+        widget.mqtt = self.mqtt
+        self.bind(cfg=widget.setter('cfg'))
+        self.bind(mqtt=widget.setter('mqtt'))
+
+        # keep the overlay on top
+        self.add_widget(widget, index=self.children.index(self.ids.overlay) + 1)
+
+    def _build_late(self):
+        from alarm import AlarmClock
+        from environment import EnvironmentWidget
+        from pager import DevicePager
+        from player import FavButtonWidget, PlayerWidget
+        from thing import WifiRepeater
 
-        # Initialize the things
-        for sec in filter(lambda s: s.startswith("Thing:"),
-                          self.cfg.sections()):
-            t = Thing(cfg_name=sec,
-                      cfg=self.cfg,
-                      mqtt=self.mqtt)
-            self.bind(cfg=t.setter('cfg'))
-            self.bind(mqtt=t.setter('mqtt'))
-            self.add_widget(t)
-
-        for sec in filter(lambda s: s.startswith("Shelly"),
-                          self.cfg.sections()):
-            sb = ShellyButton(cfg_name=sec,
-                              cfg=self.cfg,
-                              mqtt=self.mqtt)
-            self.bind(cfg=sb.setter('cfg'))
-            self.bind(mqtt=sb.setter('mqtt'))
-            self.add_widget(sb)
-
-        if "WifiRepeater" in self.cfg.sections():
+        self._add_late(EnvironmentWidget(pos=(330, 200)))
+        player = PlayerWidget(pos=(330, 0))
+        self._add_late(player)
+        self.ids.backlight.bind(power=lambda _instance, power: setattr(player, "marquee_paused", not power))
+        self._add_late(FavButtonWidget(pos=(700, 200)))
+
+        if self.cfg.wifi_repeater is not None:
             self.wifi_repeater = WifiRepeater(self.cfg, self.mqtt,
                                               pos=(700, 380))
-            self.add_widget(self.wifi_repeater)
+            self.add_widget(self.wifi_repeater, index=self.children.index(self.ids.overlay) + 1)
+
+        # Things and Shelly buttons, on top of the home page
+        self.pager = DevicePager(size=self.size)
+        self._add_late(self.pager)
+
+        self.alarms = AlarmClock(self.cfg, self.mqtt, self.ids.backlight, self.ids.clock)
+        self.alarms.start()
+
+        STARTUP.mark("widgets_built")
+        self.built = True
+
+    def reload_config(self, cfg):
+        """Apply changed settings, only the devices of changed sections are rebuilt"""
+        # Update in place, all widgets share the settings object
+        devices, changed = self.cfg.update(cfg)
+
+        if self.pager is not None and devices:
+            self.pager.reload(devices)
+
+        if "wifi_repeater" in changed and self.pager is not None:
+            if self.wifi_repeater is not None:
+                self.wifi_repeater.release()
+                self.remove_widget(self.wifi_repeater)
+                self.wifi_repeater = None
+            if self.cfg.wifi_repeater is not None:
+                from thing import WifiRepeater
+                self.wifi_repeater = WifiRepeater(self.cfg, self.mqtt,
+                                                  pos=(700, 380))
+                self.add_widget(self.wifi_repeater, index=self.children.index(self.pager) + 1)
+
+        others = [name for name in changed if name != "wifi_repeater"]
+        if others:
+            Logger.warning("Config: Changes in %s take effect after a restart", ", ".join(sorted(others)))
 
     def on_touch_down(self, touch):
         if self.ids.backlight is not None and not self.ids.backlight.power:
@@ -107,21 +158,112 @@ class SmartPanelWidget(RelativeLayout):
             if block:
                 return True
 
-        return super(SmartPanelWidget, self).on_touch_down(touch)
+        if super(SmartPanelWidget, self).on_touch_down(touch):
+            return True
+
+        # Swipes that start on an empty spot change the device page
+        if self.pager is not None:
+            self.pager.begin_swipe(touch)
+            return True
+
+        return False
+
+
+FRAME_TIME = REGISTRY.histogram("smartpanel_frame_seconds",
+                                "Time between two frames of the main loop",
+                                buckets=(0.005, 0.01, 0.017, 0.025, 0.034, 0.05, 0.1, 0.25, 0.5, 1))
+
+
+CONFIG_RELOAD = REGISTRY.histogram("smartpanel_config_reload_seconds",
+                                   "Time to apply a changed configuration")
 
 
 class SmartPanelApp(App):
-    def __init__(self, cfg, **kwargs):
+    def __init__(self, cfg, cfg_path="smartpanel.cfg", **kwargs):
         super(SmartPanelApp, self).__init__(**kwargs)
         
         self.cfg = cfg
+        self.cfg_path = cfg_path
+        self.cfg_watcher = None
+        self.watchdog = None
+        self.gc_monitor = None
+        self.soak = None
+        self.metrics = None
+        self._frame_event = None
 
     def build(self):
+        Builder.load_string(KV)
+        STARTUP.mark("kv_compiled")
+
         widget = SmartPanelWidget(self.cfg,
                                   size=(800, 480))
-        
+        STARTUP.mark("first_widgets_built")
+
         return widget
 
+    def on_start(self):
+        self._frame_event = Clock.schedule_interval(lambda dt: FRAME_TIME.observe(dt), 0)
+
+        # optional, not needed for the first frame
+        from configwatch import ConfigWatcher
+        from gcmonitor import GcMonitor
+        from soak import SoakTest
+        from watchdog import StallWatchdog
+
+        self.watchdog = StallWatchdog.from_config(self.cfg)
+        if self.watchdog:
+            self.watchdog.start()
+
+        self.gc_monitor = GcMonitor.from_config(self.cfg)
+        if self.gc_monitor:
+            self.gc_monitor.start()
+            # the objects built until then live as long as the panel
+            self.root.bind(built=lambda _instance, _value: self.gc_monitor.freeze())
+
+        self.soak = SoakTest.from_config(self.cfg, self)
+        if self.soak:
+            self.root.bind(built=lambda _instance, _value: self.soak.start())
+
+        self.metrics = MetricsServer.from_config(self.cfg, self.root.mqtt)
+        if self.metrics:
+            self.metrics.start()
+
+        self.cfg_watcher = ConfigWatcher(self.cfg_path, self._on_config_change)
+        self.cfg_watcher.start()
+
+    def _on_config_change(self):
+        start = time.perf_counter()
+
+        try:
+            cfg = load_settings(self.cfg_path)
+        except ConfigError as e:
+            Logger.warning("Config: Ignoring changed configuration: %s", e)
+            return
+
+        self.root.reload_config(cfg)
+
+        duration = time.perf_counter() - start
+        CONFIG_RELOAD.observe(duration)
+        Logger.info("Config: Reloaded in %.1f ms", 1000 * duration)
+
+    def on_stop(self):
+        self._frame_event.cancel()
+
+        if self.watchdog:
+            self.watchdog.stop()
+
+        if self.gc_monitor:
+            self.gc_monitor.stop()
+
+        if self.soak:
+            self.soak.stop()
+
+        if self.metrics:
+            self.metrics.stop()
+
+        if self.cfg_watcher:
+            self.cfg_watcher.stop()
+
 
 running = True
 
@@ -148,12 +290,19 @@ async def main():
         './resources/FiraSans-Regular.ttf'
     ])
 
-    config = configparser.ConfigParser()
-    config.read("smartpanel.cfg")
+    try:
+        config = load_settings("smartpanel.cfg")
+    except ConfigError as e:
+        Logger.critical("Config: %s", e)
+        sys.exit(1)
+    STARTUP.mark("config_parsed")
 
-    app = SmartPanelApp(config)
+    app = SmartPanelApp(config, "smartpanel.cfg")
     await app.async_run()
 
+    if app.soak is not None and app.soak.failed:
+        sys.exit(1)
+
 
 if __name__ == '__main__':
     if sys.platform == 'win32':
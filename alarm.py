@@ -0,0 +1,239 @@
+"""Alarms set over MQTT
+
+The retained message on <topic>/alarm holds one alarm per line, either
+"HH:MM" for every day or "minute hour day month weekday" like cron. The next
+due time of every alarm is kept in a heap and one Clock event is armed for
+the earliest of them, nothing is polled in between.
+"""
+
+import heapq
+import itertools
+import json
+from datetime import datetime, timedelta
+from time import time
+
+from kivy import Logger
+from kivy.clock import Clock
+
+from codec import TEXT
+from metrics import REGISTRY
+
+FIRED = REGISTRY.counter("smartpanel_alarms_fired_total",
+                         "Alarms that went off")
+JITTER = REGISTRY.histogram("smartpanel_alarm_jitter_seconds",
+                            "Delay between the due time of an alarm and its callback",
+                            buckets=(0.001, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 1))
+
+
+class AlarmError(ValueError):
+    pass
+
+
+class AlarmSpec:
+    """When an alarm is due, parsed from "HH:MM" or a cron-like line"""
+    __slots__ = ("text", "minutes", "hours", "days", "months", "weekdays", "any_day", "any_weekday")
+
+    # (first, last) of minute, hour, day, month, weekday; 0 and 7 are sunday
+    RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+    # a 29th of february may be years away
+    MAX_DAYS = 8 * 366
+
+    def __init__(self, text):
+        self.text = text
+
+        if ":" in text:
+            hour, _, minute = text.partition(":")
+            fields = [minute, hour, "*", "*", "*"]
+        else:
+            fields = text.split()
+        if len(fields) != 5:
+            raise AlarmError("Expected HH:MM or 5 fields, got '{}'".format(text))
+
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            AlarmSpec._field(field, first, last) for field, (first, last) in zip(fields, AlarmSpec.RANGES))
+        self.weekdays = frozenset(d % 7 for d in weekdays)
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    @staticmethod
+    def _field(field, first, last):
+        values = set()
+        for part in field.split(","):
+            span, _, step = part.partition("/")
+            try:
+                step = int(step) if step else 1
+                if span == "*":
+                    lo, hi = first, last
+                elif "-" in span:
+                    lo, hi = (int(v) for v in span.split("-", 1))
+                else:
+                    lo = int(span)
+                    hi = last if step > 1 else lo
+            except ValueError:
+                raise AlarmError("Invalid field '{}'".format(field)) from None
+
+            if step < 1 or not first <= lo <= hi <= last:
+                raise AlarmError("Field '{}' is not within {}-{}".format(field, first, last))
+            values.update(range(lo, hi + 1, step))
+
+        return sorted(values)
+
+    def _day_matches(self, day):
+        in_month = day.day in self.days
+        # like cron, if both are restricted either may match
+        in_week = (day.isoweekday() % 7) in self.weekdays
+        if self.any_day:
+            return in_week
+        if self.any_weekday:
+            return in_month
+        return in_month or in_week
+
+    def next_after(self, after):
+        """Return the first due time after the datetime after, None if there is none"""
+        start = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        day = start.replace(hour=0, minute=0)
+
+        for _ in range(AlarmSpec.MAX_DAYS):
+            if day.month in self.months and self._day_matches(day):
+                for hour in self.hours:
+                    for minute in self.minutes:
+                        due = day.replace(hour=hour, minute=minute)
+                        if due >= start:
+                            return due
+            day += timedelta(days=1)
+
+        return None
+
+
+class TimerScheduler:
+    """Call callbacks at wall clock times with a single Clock event"""
+    # re-armed at least this often, so that a changed system time is noticed
+    MAX_SLEEP = 3600
+
+    def __init__(self):
+        # [due, sequence, callback], cancelled entries have no callback
+        self.heap = []
+        self.sequence = itertools.count()
+        self.event = None
+
+    def add(self, due, cb):
+        """Call cb(due, now) at the time due, return an entry to cancel it"""
+        entry = [due, next(self.sequence), cb]
+        heapq.heappush(self.heap, entry)
+        if self.heap[0] is entry:
+            self._arm()
+        return entry
+
+    @staticmethod
+    def cancel(entry):
+        entry[2] = None
+
+    def next_due(self):
+        self._drop_cancelled()
+        return self.heap[0][0] if self.heap else None
+
+    def close(self):
+        self.heap = []
+        if self.event is not None:
+            self.event.cancel()
+            self.event = None
+
+    def _drop_cancelled(self):
+        while self.heap and self.heap[0][2] is None:
+            heapq.heappop(self.heap)
+
+    def _arm(self):
+        if self.event is not None:
+            self.event.cancel()
+            self.event = None
+
+        self._drop_cancelled()
+        if self.heap:
+            delay = min(max(0, self.heap[0][0] - time()), TimerScheduler.MAX_SLEEP)
+            self.event = Clock.schedule_once(self._run, delay)
+
+    def _run(self, _dt):
+        self.event = None
+        now = time()
+        while self.heap and self.heap[0][0] <= now:
+            due, _, cb = heapq.heappop(self.heap)
+            if cb is not None:
+                cb(due, now)
+
+        self._arm()
+
+
+class AlarmClock:
+    def __init__(self, cfg, mqttc, backlight, clock_widget):
+        self.cfg = cfg
+        self.mqtt = mqttc
+        self.backlight = backlight
+        self.clock_widget = clock_widget
+
+        self.scheduler = TimerScheduler()
+        # spec: scheduler entry
+        self.entries = dict()
+
+    def start(self):
+        self.mqtt.subscribe(self.cfg.mqtt.alarm_topic, self._on_message, codec=TEXT)
+
+    def close(self):
+        self.mqtt.unsubscribe(self.cfg.mqtt.alarm_topic, self._on_message)
+        self.scheduler.close()
+        self.entries = dict()
+
+    def _on_message(self, text):
+        Clock.schedule_once(lambda dt: self.set_alarms(text))
+
+    def set_alarms(self, text):
+        """Replace all alarms by the ones in text, one per line"""
+        specs = []
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            try:
+                specs.append(AlarmSpec(line.strip()))
+            except AlarmError as e:
+                Logger.warning("Alarm: Ignoring alarm: %s", e)
+
+        for entry in self.entries.values():
+            TimerScheduler.cancel(entry)
+        self.entries = dict()
+
+        now = datetime.now()
+        for spec in specs:
+            self._schedule(spec, now)
+        self._show_next()
+
+    def _schedule(self, spec, after):
+        due = spec.next_after(after)
+        if due is None:
+            Logger.warning("Alarm: %s is never due", spec.text)
+            return
+
+        self.entries[spec] = self.scheduler.add(due.timestamp(), lambda d, n: self._on_alarm(spec, d, n))
+        Logger.info("Alarm: %s is due at %s", spec.text, due.isoformat(sep=" "))
+
+    def _show_next(self):
+        due = self.scheduler.next_due()
+        self.clock_widget.set_alarm(None if due is None else datetime.fromtimestamp(due).strftime("%H:%M"))
+
+    def _on_alarm(self, spec, due, now):
+        jitter = now - due
+        FIRED.inc()
+        JITTER.observe(jitter)
+        Logger.info("Alarm: %s triggered at %s, %.1f ms after the due time",
+                    spec.text, datetime.fromtimestamp(now).isoformat(sep=" ", timespec="milliseconds"),
+                    1000 * jitter)
+
+        self.backlight.power = True
+        self.mqtt.publish(self.cfg.mqtt.alarm_event_topic,
+                          json.dumps({"alarm": spec.text,
+                                      "due": datetime.fromtimestamp(due).isoformat(timespec="seconds"),
+                                      "triggered": datetime.fromtimestamp(now).isoformat(timespec="milliseconds"),
+                                      "jitter": round(jitter, 4)}),
+                          qos=1)
+
+        # from the due time, so that an early callback does not go off twice
+        self._schedule(spec, datetime.fromtimestamp(due))
+        self._show_next()
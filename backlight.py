@@ -6,6 +6,11 @@ from kivy.uix.widget import Widget
 from rpi_backlight import Backlight
 from rpi_backlight.utils import detect_board_type, FakeBacklightSysfs
 
+from metrics import REGISTRY
+
+WAKES = REGISTRY.counter("smartpanel_backlight_wakes_total",
+                         "Times the backlight has been switched on")
+
 
 class BacklightControl(Widget):
     conf = DictProperty(None, allownone=True)
@@ -41,12 +46,12 @@ class BacklightControl(Widget):
 
     def on_cfg(self, _instance, _value):
         # cache maximal brightness setting
-        self._max_br = min(100, int(self.cfg.get("Backlight", "brightness", fallback=100)) if self.cfg else 100)
+        self._max_br = self.cfg.backlight.brightness if self.cfg else 100
         # update, if switched on
         if self.power:
             self._on_brightness(_instance, None)
 
-        self.timeout = self.cfg.get("Backlight", "timeout", fallback=None) if self.cfg else None
+        self.timeout = self.cfg.backlight.timeout if self.cfg else None
 
     def _on_conf(self, _instance, _value):
         # cache maximal brightness setting
@@ -66,6 +71,7 @@ class BacklightControl(Widget):
             return
 
         if self.power:
+            WAKES.inc()
             self._cancel_backlight_clock()
             self._backlight.power = True
             self._backlight.fade_duration = 0.2
@@ -0,0 +1,116 @@
+"""Decoders for MQTT payloads
+
+A handler declares the payload type it expects when it subscribes, e.g.
+mqttc.subscribe(topic, cb, codec=ON_OFF), and is then called with the
+decoded value instead of the message. Payloads are matched and parsed as
+bytes, without decoding them to a string first. Payloads that do not
+decode are counted per codec and logged, the handler gets the default of
+the codec or is not called if there is none.
+"""
+
+import json
+import math
+
+from kivy import Logger
+
+from metrics import REGISTRY
+
+# the handler is not called for invalid payloads
+NO_DEFAULT = object()
+
+
+class Codec:
+    def __init__(self, name, default=NO_DEFAULT):
+        self.name = name
+        self.default = default
+        self.errors = REGISTRY.counter("smartpanel_codec_{}_errors_total".format(name),
+                                       "Payloads that are not valid {}".format(name.replace("_", " ")))
+
+    def decode(self, payload):
+        """Return the value of a payload, raise ValueError if it is invalid"""
+        raise NotImplementedError()
+
+    def reject(self, message):
+        self.errors.inc()
+        Logger.warning("Codec: Invalid %s payload on %s: %r", self.name, message.topic, message.payload[:64])
+
+    def handler(self, cb):
+        """Wrap cb(value) into an MQTT callback"""
+        def on_message(_client, _userdata, message):
+            try:
+                value = self.decode(message.payload)
+            except ValueError:
+                self.reject(message)
+                if self.default is NO_DEFAULT:
+                    return
+                value = self.default
+
+            cb(value)
+
+        return on_message
+
+
+class Enum(Codec):
+    """One of a fixed set of payloads, surrounding whitespace is ignored"""
+
+    def __init__(self, name, values, default=NO_DEFAULT):
+        super(Enum, self).__init__(name, default)
+        # payload: value
+        self.values = dict(values)
+
+    def decode(self, payload):
+        try:
+            return self.values[payload]
+        except KeyError:
+            pass
+
+        # only payloads that do not match exactly are copied
+        try:
+            return self.values[payload.strip()]
+        except KeyError:
+            raise ValueError(payload) from None
+
+
+class Float(Codec):
+    def decode(self, payload):
+        # float() parses bytes directly
+        value = float(payload)
+        if not math.isfinite(value):
+            raise ValueError(payload)
+        return value
+
+
+class Int(Codec):
+    """An integer, numbers like 42.0 are accepted as well"""
+
+    def decode(self, payload):
+        try:
+            return int(payload)
+        except ValueError:
+            value = float(payload)
+            if not value.is_integer():
+                raise
+            return int(value)
+
+
+class Text(Codec):
+    def decode(self, payload):
+        # UnicodeDecodeError is a ValueError
+        return payload.decode("utf-8")
+
+
+class Json(Codec):
+    def decode(self, payload):
+        return json.loads(payload)
+
+
+# Tasmota
+ON_OFF = Enum("on_off", {b"ON": True, b"OFF": False}, default=None)
+ONLINE = Enum("online", {b"Online": True, b"Offline": False}, default=None)
+# Shelly
+RELAY = Enum("relay", {b"on": "on", b"off": "off"}, default=None)
+
+FLOAT = Float("float")
+INT = Int("int")
+TEXT = Text("text")
+JSON = Json("json")
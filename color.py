@@ -2,8 +2,19 @@ from kivy.graphics import Color
 
 
 class RMColor:
+    # (name, alpha): rgba, the colors are looked up on every state change
+    _rgba = dict()
+
     @staticmethod
     def get_rgba(name, alpha=1):
+        """The color as [r, g, b, a] list, shared between callers, do not modify it"""
+        rgba = RMColor._rgba.get((name, alpha))
+        if rgba is None:
+            rgba = RMColor._rgba[(name, alpha)] = RMColor._lookup(name, alpha)
+        return rgba
+
+    @staticmethod
+    def _lookup(name, alpha):
         # grey is fallback
         c = (77, 77, 76)
 
@@ -39,13 +50,10 @@ class RMColor:
 
 
 class StateColor:
-    def __init__(self, cfg, section,
-                 default_on="green", default_off="red", default_neutral="grey"):
-        self.cfg = cfg
-
-        self.color_on = self.cfg.get(section, "color_on", fallback=default_on)
-        self.color_off = self.cfg.get(section, "color_off", fallback=default_off)
-        self.color_neutral = self.cfg.get(section, "color_neutral", fallback=default_neutral)
+    def __init__(self, conf):
+        self.color_on = conf.color_on
+        self.color_off = conf.color_off
+        self.color_neutral = conf.color_neutral
 
     def get(self, state):
         _pwr_state = state.get_pwr_state()
@@ -0,0 +1,107 @@
+"""Watch the configuration file and report changes
+
+On Linux the directory of the file is watched with inotify, so that editors
+which replace the file are noticed as well. Elsewhere the modification time
+is polled.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+
+from kivy import Logger
+from kivy.clock import Clock
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_CLOEXEC = 0o2000000
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class ConfigWatcher:
+    # seconds to wait for more changes before reporting
+    DEBOUNCE = 0.3
+    POLL_INTERVAL = 2
+
+    def __init__(self, path, on_change):
+        self.path = os.path.abspath(path)
+        self.on_change = on_change
+
+        self._trigger = Clock.create_trigger(lambda dt: self.on_change(), ConfigWatcher.DEBOUNCE)
+        self._stopped = threading.Event()
+        self._thread = None
+        self._poll_event = None
+        self._mtime = None
+
+    def start(self):
+        fd = self._inotify_init()
+        if fd is not None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._watch, args=(fd,), name="ConfigWatcher", daemon=True)
+            self._thread.start()
+        else:
+            self._mtime = self._get_mtime()
+            self._poll_event = Clock.schedule_interval(self._poll, ConfigWatcher.POLL_INTERVAL)
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._poll_event is not None:
+            self._poll_event.cancel()
+            self._poll_event = None
+
+    def _inotify_init(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+
+        wd = libc.inotify_add_watch(fd, os.path.dirname(self.path).encode(),
+                                    IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+        if wd < 0:
+            Logger.warning("Config: Cannot watch %s: %s", self.path, os.strerror(ctypes.get_errno()))
+            os.close(fd)
+            return None
+
+        return fd
+
+    def _watch(self, fd):
+        name = os.path.basename(self.path).encode()
+        try:
+            while not self._stopped.is_set():
+                readable, _, _ = select.select([fd], [], [], 1)
+                if not readable:
+                    continue
+
+                buf = os.read(fd, 4096)
+                offset = 0
+                while offset < len(buf):
+                    _wd, _mask, _cookie, length = EVENT_HEADER.unpack_from(buf, offset)
+                    offset += EVENT_HEADER.size
+                    if buf[offset:offset + length].rstrip(b"\0") == name:
+                        self._trigger()
+                    offset += length
+        finally:
+            os.close(fd)
+
+    def _get_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _poll(self, _dt):
+        mtime = self._get_mtime()
+        if mtime != self._mtime:
+            self._mtime = mtime
+            self._trigger()
@@ -0,0 +1,142 @@
+"""Album covers, decoded in worker threads and cached as textures
+
+Decoding and scaling needs Pillow, without it no covers are shown. Only the
+texture upload runs in the main thread.
+"""
+
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from kivy import Logger
+from kivy.clock import Clock
+from kivy.graphics.texture import Texture
+
+from metrics import REGISTRY
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+CACHE_BYTES = REGISTRY.gauge("smartpanel_cover_cache_bytes",
+                             "Bytes of cover textures in the cache")
+CACHE_HITS = REGISTRY.counter("smartpanel_cover_cache_hits_total",
+                              "Covers shown from the cache without decoding")
+DECODES = REGISTRY.counter("smartpanel_cover_decodes_total",
+                           "Covers decoded and scaled")
+
+COVER_FILES = ("cover.jpg", "cover.png", "folder.jpg", "folder.png", "front.jpg", "front.png")
+
+
+class TextureCache:
+    """Least recently used textures, bounded by their size in bytes
+
+    Missing covers are cached as None, so that they are not looked up again
+    in the directory. Image data for the key replaces them.
+    """
+    MISSING_BYTES = 64
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        # key: (texture, size in bytes)
+        self.entries = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        self.entries.move_to_end(key)
+        return self.entries[key][0]
+
+    def put(self, key, texture, nbytes):
+        if key in self.entries:
+            self.bytes -= self.entries.pop(key)[1]
+
+        self.entries[key] = (texture, nbytes)
+        self.bytes += nbytes
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            self.bytes -= self.entries.popitem(last=False)[1][1]
+
+        CACHE_BYTES.set(self.bytes)
+
+
+class CoverLoader:
+    def __init__(self, size, max_bytes, workers=1):
+        self.size = size
+        self.cache = TextureCache(max_bytes)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="CoverLoader")
+
+        # key: callbacks waiting for a decode
+        self.pending = dict()
+
+        if Image is None:
+            Logger.warning("Cover: Pillow is not installed, covers are not shown")
+
+    def cached(self, key):
+        """Return the cached texture for key, None if there is none"""
+        return self.cache.get(key) if key in self.cache else None
+
+    def request(self, key, on_done, data=None, directory=None):
+        """Call on_done with the texture for key, None if there is no cover
+
+        The cover is decoded from data or looked up in directory unless it
+        is in the cache. Must be called in the main thread, on_done is
+        called in the main thread as well.
+        """
+        if key in self.cache and not (data and self.cache.get(key) is None):
+            CACHE_HITS.inc()
+            on_done(self.cache.get(key))
+            return
+
+        if Image is None:
+            on_done(None)
+            return
+
+        if key in self.pending:
+            self.pending[key].append(on_done)
+            return
+
+        self.pending[key] = [on_done]
+        future = self.executor.submit(self._decode, data, directory, self.size)
+        future.add_done_callback(lambda f: Clock.schedule_once(lambda dt: self._on_decoded(key, f)))
+
+    @staticmethod
+    def _decode(data, directory, size):
+        """Return the size and RGBA pixels of the cover, bottom row first, None if there is none"""
+        if data:
+            source = BytesIO(data)
+        else:
+            source = next((os.path.join(directory, name) for name in COVER_FILES
+                           if directory and os.path.isfile(os.path.join(directory, name))), None)
+            if source is None:
+                return None
+
+        with Image.open(source) as img:
+            img.thumbnail((size, size))
+            img = img.convert("RGBA").transpose(Image.FLIP_TOP_BOTTOM)
+            DECODES.inc()
+            return img.size, img.tobytes()
+
+    def _on_decoded(self, key, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            # Pillow raises more than OSError, e.g. DecompressionBombError or
+            # SyntaxError, the placeholder is shown for any of them
+            Logger.warning("Cover: Cannot decode the cover of %s: %r", key, e)
+            result = None
+
+        texture = None
+        if result is None:
+            self.cache.put(key, None, TextureCache.MISSING_BYTES)
+        else:
+            size, pixels = result
+            texture = Texture.create(size=size, colorfmt="rgba")
+            texture.blit_buffer(pixels, colorfmt="rgba", bufferfmt="ubyte")
+            self.cache.put(key, texture, len(pixels))
+
+        for on_done in self.pending.pop(key, []):
+            on_done(texture)
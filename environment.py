@@ -1,9 +1,13 @@
 """Display data about the room environment"""
 
+import math
+
+from kivy import Logger
 from kivy.lang import Builder
 from kivy.properties import StringProperty, ListProperty, ObjectProperty
 from kivy.uix.relativelayout import RelativeLayout
 
+from codec import FLOAT, JSON
 from color import RMColor
 
 Builder.load_string('''
@@ -145,63 +149,175 @@ class EnvironmentWidget(RelativeLayout):
     mqtt = ObjectProperty(None)
 
     def __init__(self, **kwargs):
+        self.extractors = []
+        self.rejected_payloads = 0
+        self.suppressed_updates = 0
+
+        self.temperature_filter = ValueFilter()
+        self.humidity_filter = ValueFilter()
+        self.air_quality_filter = ValueFilter(quantize=math.floor)
+
         self._set_temperature(None)
         self._set_humidity(None)
         super(EnvironmentWidget, self).__init__(**kwargs)
 
     def on_cfg(self, _instance, _value):
+        if self.cfg and self.cfg.environment:
+            conf = self.cfg.environment
+            self.temperature_filter = self._create_filter(conf.temperature_filter)
+            self.humidity_filter = self._create_filter(conf.humidity_filter)
+            self.air_quality_filter = self._create_filter(conf.air_quality_filter, quantize=math.floor)
+
         self.on_mqtt(_instance, _value)
 
+    @staticmethod
+    def _create_filter(conf, quantize=round):
+        return ValueFilter(deadband=conf.deadband, hysteresis=conf.hysteresis, quantize=quantize)
+
     def on_mqtt(self, _instance, _value):
-        if not self.cfg or not self.mqtt:
+        if not self.cfg or not self.mqtt or not self.cfg.environment:
             return
 
-        self.mqtt.subscribe(self.cfg.get('Environment', "temperature"),
-                            self._on_temperature_update)
-        self.mqtt.subscribe(self.cfg.get('Environment', "humidity"),
-                            self._on_humidity_update)
-        self.mqtt.subscribe(self.cfg.get('Environment', "air_quality"),
-                            self._on_air_quality_update)
+        conf = self.cfg.environment
+        if conf.topic:
+            self._setup_json(conf)
+        else:
+            for topic, callback in [(conf.temperature_topic, self._on_temperature_update),
+                                    (conf.humidity_topic, self._on_humidity_update),
+                                    (conf.air_quality_topic, self._on_air_quality_update)]:
+                if topic:
+                    self.mqtt.subscribe(topic, callback, codec=FLOAT)
+
+    def _setup_json(self, conf):
+        self.extractors = []
+        for path, setter in [(conf.temperature_path, self._set_temperature),
+                             (conf.humidity_path, self._set_humidity),
+                             (conf.air_quality_path, self._set_air_quality)]:
+            if path:
+                self.extractors.append((JsonPath(path), setter))
+
+        self.mqtt.subscribe(conf.topic, self._on_json_update, codec=JSON)
+
+    def _on_json_update(self, data):
+        for extractor, setter in self.extractors:
+            try:
+                value = float(extractor.extract(data))
+            except (LookupError, TypeError, ValueError):
+                self._reject("no numeric value at {}".format(extractor))
+                continue
+            # json.loads accepts NaN and Infinity
+            if not math.isfinite(value):
+                self._reject("no finite value at {}".format(extractor))
+                continue
 
-    def _on_temperature_update(self, _client, _userdata, message):
-        payload = message.payload.decode("utf-8")
-        self._set_temperature(payload)
+            setter(value)
 
-    def _on_humidity_update(self, _client, _userdata, message):
-        payload = message.payload.decode("utf-8")
-        self._set_humidity(payload)
+    def _on_temperature_update(self, value):
+        self._set_temperature(value)
 
-    def _on_air_quality_update(self, _client, _userdata, message):
-        payload = message.payload.decode("utf-8")
-        self._set_air_quality(payload)
+    def _on_humidity_update(self, value):
+        self._set_humidity(value)
+
+    def _on_air_quality_update(self, value):
+        self._set_air_quality(value)
+
+    def _reject(self, reason):
+        self.rejected_payloads += 1
+        Logger.warning("Environment: Rejected payload on %s (%s)", self.cfg.environment.topic, reason)
 
     def _set_temperature(self, temperature):
         if temperature is None:
+            self.temperature_filter.reset()
             self.temperature = "--"
             self.temperature_value_color = RMColor.get_rgba("reboot")
             self.temperature_label_color = RMColor.get_rgba("reboot")
-        else:
-            t = round(float(temperature))
-            self.temperature = "{:02d}".format(t)
+            return
+
+        t = self.temperature_filter.update(temperature)
+        if t is None:
+            self.suppressed_updates += 1
+            return
+
+        if self.temperature == "--":
             self.temperature_value_color = RMColor.get_rgba(EnvironmentWidget.VALUE_COLOR)
             self.temperature_label_color = RMColor.get_rgba(EnvironmentWidget.LABEL_COLOR)
+        self.temperature = "{:02d}".format(t)
 
     def _set_humidity(self, humidity):
         if humidity is None:
+            self.humidity_filter.reset()
             self.humidity = "--"
             self.humidity_value_color = RMColor.get_rgba("reboot")
             self.humidity_label_color = RMColor.get_rgba("reboot")
-        else:
-            h = round(float(humidity))
-            self.humidity = "{:02d}".format(h)
+            return
+
+        h = self.humidity_filter.update(humidity)
+        if h is None:
+            self.suppressed_updates += 1
+            return
+
+        if self.humidity == "--":
             self.humidity_value_color = RMColor.get_rgba(EnvironmentWidget.VALUE_COLOR)
             self.humidity_label_color = RMColor.get_rgba(EnvironmentWidget.LABEL_COLOR)
+        self.humidity = "{:02d}".format(h)
 
     def _set_air_quality(self, air_quality):
-        q = float(air_quality)
+        q = self.air_quality_filter.update(air_quality)
+        if q is None:
+            self.suppressed_updates += 1
+            return
+
         off = RMColor.get_rgba("off")
         self.quality_color_1 = off if q < 1 else RMColor.get_rgba(EnvironmentWidget.QUALITY_COLOR[0])
         self.quality_color_2 = off if q < 2 else RMColor.get_rgba(EnvironmentWidget.QUALITY_COLOR[1])
         self.quality_color_3 = off if q < 3 else RMColor.get_rgba(EnvironmentWidget.QUALITY_COLOR[2])
         self.quality_color_4 = off if q < 4 else RMColor.get_rgba(EnvironmentWidget.QUALITY_COLOR[3])
         self.quality_color_5 = off if q < 5 else RMColor.get_rgba(EnvironmentWidget.QUALITY_COLOR[4])
+
+
+class ValueFilter:
+    """Deadband and hysteresis for a quantized display value
+
+    Changes smaller than the deadband are ignored. The displayed value only
+    moves on once the reading is further than the hysteresis away from it.
+    """
+    def __init__(self, deadband=0.0, hysteresis=0.0, quantize=round):
+        self.deadband = deadband
+        self.hysteresis = hysteresis
+        self.quantize = quantize
+
+        self.value = None
+        self.shown = None
+
+    def reset(self):
+        self.value = None
+        self.shown = None
+
+    def update(self, value):
+        """Return the new display value, or None if the visible output does not change"""
+        if self.value is not None and abs(value - self.value) < self.deadband:
+            return None
+        self.value = value
+
+        if self.shown is not None and \
+                self.quantize(value - self.hysteresis) <= self.shown <= self.quantize(value + self.hysteresis):
+            return None
+
+        self.shown = self.quantize(value)
+        return self.shown
+
+
+class JsonPath:
+    """Pre-compiled dotted path into a JSON document, e.g. 'AM2301.Temperature'"""
+    def __init__(self, path):
+        self.path = path
+        self.keys = tuple(int(k) if k.isdigit() else k
+                          for k in path.split("."))
+
+    def extract(self, data):
+        for k in self.keys:
+            data = data[k]
+        return data
+
+    def __str__(self):
+        return self.path
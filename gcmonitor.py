@@ -0,0 +1,84 @@
+"""Tune the garbage collector and measure its pauses
+
+The widgets, settings and modules that exist once the panel is built live
+until it exits. Freezing them moves them to the permanent generation, so
+collections do not scan them again, and higher thresholds make collections
+of the short-lived objects of MQTT messages rarer.
+"""
+
+import gc
+import time
+
+from kivy import Logger
+
+from metrics import REGISTRY
+
+PAUSES = REGISTRY.histogram("smartpanel_gc_pause_seconds",
+                            "Duration of garbage collections",
+                            buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.017, 0.034, 0.1))
+SLOW = REGISTRY.counter("smartpanel_gc_slow_collections_total",
+                        "Garbage collections that took longer than [GC] slow_pause")
+COLLECTED = REGISTRY.counter("smartpanel_gc_collected_objects_total",
+                             "Unreachable objects freed by garbage collections")
+FROZEN = REGISTRY.gauge("smartpanel_gc_frozen_objects",
+                        "Objects in the permanent generation")
+
+
+class GcMonitor:
+    def __init__(self, freeze=True, thresholds=None, slow_pause=0.017):
+        self.freeze_objects = freeze
+        self.thresholds = thresholds
+        self.slow_pause = slow_pause
+
+        self._start = None
+        self._default_thresholds = None
+
+    @staticmethod
+    def from_config(cfg):
+        if cfg.gc is None:
+            return None
+
+        return GcMonitor(freeze=cfg.gc.freeze,
+                         thresholds=cfg.gc.thresholds,
+                         slow_pause=cfg.gc.slow_pause)
+
+    def start(self):
+        if self.thresholds is not None:
+            self._default_thresholds = gc.get_threshold()
+            gc.set_threshold(*self.thresholds)
+        gc.callbacks.append(self._on_gc)
+
+    def stop(self):
+        if self._on_gc in gc.callbacks:
+            gc.callbacks.remove(self._on_gc)
+        if self._default_thresholds is not None:
+            gc.set_threshold(*self._default_thresholds)
+            self._default_thresholds = None
+
+    def freeze(self):
+        """Move all objects that survive a full collection to the permanent generation"""
+        if not self.freeze_objects:
+            return
+
+        start = time.perf_counter()
+        gc.collect()
+        gc.freeze()
+        FROZEN.set(gc.get_freeze_count())
+        Logger.info("GC: Froze %d objects in %.1f ms", gc.get_freeze_count(), 1000 * (time.perf_counter() - start))
+
+    def _on_gc(self, phase, info):
+        if phase == "start":
+            self._start = time.perf_counter()
+            return
+
+        if self._start is None:
+            return
+        duration = time.perf_counter() - self._start
+        self._start = None
+
+        PAUSES.observe(duration)
+        COLLECTED.inc(info["collected"])
+        if duration > self.slow_pause:
+            SLOW.inc()
+            Logger.warning("GC: Collection of generation %d took %.1f ms, %d objects collected",
+                           info["generation"], 1000 * duration, info["collected"])
@@ -0,0 +1,125 @@
+"""Single line label that scrolls text that does not fit
+
+The text is rendered to a texture only when it changes. Scrolling moves the
+texture coordinates of two rectangles, the second one shows the start of
+the text again after a gap, so no text layout happens per frame.
+"""
+
+from kivy.clock import Clock
+from kivy.core.text import Label as CoreLabel
+from kivy.graphics import Color, Rectangle
+from kivy.properties import BooleanProperty, ColorProperty, NumericProperty, StringProperty
+from kivy.uix.widget import Widget
+
+
+class MarqueeLabel(Widget):
+    text = StringProperty("")
+    font_size = NumericProperty(20)
+    color = ColorProperty([1, 1, 1, 1])
+
+    # scroll long text, otherwise it is shortened like a Label with shorten
+    scroll = BooleanProperty(False)
+    paused = BooleanProperty(False)
+    # pixels per second
+    speed = NumericProperty(30)
+    # pixels between the end and the start of the text
+    gap = NumericProperty(40)
+
+    FPS = 30
+
+    def __init__(self, **kwargs):
+        super(MarqueeLabel, self).__init__(**kwargs)
+
+        self.offset = 0
+        self._texture = None
+        self._scroll_event = None
+
+        with self.canvas:
+            self._color = Color(rgba=self.color)
+            self._first = Rectangle(size=(0, 0))
+            self._second = Rectangle(size=(0, 0))
+
+        self._render_trigger = Clock.create_trigger(self._render)
+        self.bind(text=self._render_trigger,
+                  font_size=self._render_trigger,
+                  scroll=self._render_trigger,
+                  size=self._on_size,
+                  pos=self._update_rects,
+                  paused=self._update_clock,
+                  color=self._on_color)
+        self._render_trigger()
+
+    def _on_color(self, _instance, value):
+        self._color.rgba = value
+
+    def _on_size(self, _instance, _value):
+        # shortened text depends on the width
+        if self.scroll:
+            self._update_rects()
+            self._update_clock()
+        else:
+            self._render_trigger()
+
+    def _render(self, *_args):
+        # rendered white, the color is applied by the Color instruction
+        if self.scroll:
+            label = CoreLabel(text=self.text, font_size=self.font_size)
+        else:
+            label = CoreLabel(text=self.text, font_size=self.font_size,
+                              text_size=(self.width, None), shorten=True)
+        label.refresh()
+
+        self._texture = label.texture
+        self._first.texture = self._texture
+        self._second.texture = self._texture
+        self.offset = 0
+
+        self._update_rects()
+        self._update_clock()
+
+    def _scrolling(self):
+        return self.scroll and self._texture is not None and self._texture.width > self.width
+
+    def _update_clock(self, *_args):
+        run = self._scrolling() and not self.paused
+        if run and self._scroll_event is None:
+            self._scroll_event = Clock.schedule_interval(self._scroll, 1 / MarqueeLabel.FPS)
+        elif not run and self._scroll_event is not None:
+            self._scroll_event.cancel()
+            self._scroll_event = None
+            self.offset = 0
+            self._update_rects()
+
+    def _scroll(self, dt):
+        self.offset = (self.offset + self.speed * dt) % (self._texture.width + self.gap)
+        self._update_rects()
+
+    def _update_rects(self, *_args):
+        if self._texture is None or not self._texture.width:
+            return
+
+        tw, th = self._texture.size
+        y = self.y + (self.height - th) / 2
+
+        if not self._scrolling():
+            self._set_rect(self._first, self.x, y, 0, min(tw, self.width))
+            self._set_rect(self._second, self.x, y, 0, 0)
+            return
+
+        # the end of the text, then the start again after the gap
+        first_width = max(0, min(tw - self.offset, self.width))
+        self._set_rect(self._first, self.x, y, self.offset, first_width)
+
+        second_x = tw + self.gap - self.offset
+        self._set_rect(self._second, self.x + second_x, y, 0, max(0, min(self.width - second_x, tw)))
+
+    def _set_rect(self, rect, x, y, start, width):
+        """Show the texture columns start to start + width at x, y"""
+        tw, th = self._texture.size
+        tc = self._texture.tex_coords
+        u0 = tc[0] + (tc[2] - tc[0]) * start / tw
+        u1 = tc[0] + (tc[2] - tc[0]) * (start + width) / tw
+
+        rect.pos = (x, y)
+        rect.size = (width, th)
+        rect.tex_coords = (u0, tc[1], u1, tc[3], u1, tc[5], u0, tc[7])
@@ -0,0 +1,185 @@
+"""Lightweight metrics registry with Prometheus text export
+
+Metrics are created once and then only updated in place: counters and
+gauges hold a single number, histograms a pre-allocated list of bucket
+counts.
+"""
+
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from kivy import Logger
+from kivy.clock import Clock
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, doc):
+        self.name = name
+        self.doc = doc
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, self.value
+
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name, doc):
+        self.name = name
+        self.doc = doc
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def samples(self):
+        yield self.name, self.value
+
+
+class Histogram:
+    kind = "histogram"
+
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+    def __init__(self, name, doc, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.buckets = tuple(sorted(buckets))
+        # the last bucket is +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield '{}_bucket{{le="{}"}}'.format(self.name, bound), cumulative
+        yield '{}_bucket{{le="+Inf"}}'.format(self.name), self.count
+        yield self.name + "_sum", self.sum
+        yield self.name + "_count", self.count
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = dict()
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, doc, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = cls(name, doc, **kwargs)
+                self.metrics[name] = metric
+            elif not isinstance(metric, cls):
+                raise ValueError("Metric {} is already registered as {}".format(name, metric.kind))
+            return metric
+
+    def counter(self, name, doc):
+        return self._get(Counter, name, doc)
+
+    def gauge(self, name, doc):
+        return self._get(Gauge, name, doc)
+
+    def histogram(self, name, doc, buckets=Histogram.DEFAULT_BUCKETS):
+        return self._get(Histogram, name, doc, buckets=buckets)
+
+    def render(self):
+        """Render all metrics in the Prometheus text exposition format"""
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.doc))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            for name, value in metric.samples():
+                lines.append("{} {}".format(name, value))
+
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class MetricsServer:
+    """Expose a registry via HTTP and optionally publish it over MQTT"""
+
+    def __init__(self, registry=REGISTRY, port=None, address="127.0.0.1", mqtt=None, topic=None,
+                 publish_interval=None):
+        self.registry = registry
+        self.port = port
+        self.address = address
+        self.mqtt = mqtt
+        self.topic = topic
+        self.publish_interval = publish_interval
+
+        self._httpd = None
+        self._publish_event = None
+
+    @staticmethod
+    def from_config(cfg, mqtt):
+        if cfg.metrics is None:
+            return None
+
+        return MetricsServer(port=cfg.metrics.port,
+                             address=cfg.metrics.address,
+                             mqtt=mqtt,
+                             topic=cfg.metrics.topic,
+                             publish_interval=cfg.metrics.publish_interval)
+
+    def start(self):
+        if self.port:
+            registry = self.registry
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = registry.render().encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, _format, *_args):
+                    pass
+
+            try:
+                self._httpd = ThreadingHTTPServer((self.address, self.port), Handler)
+            except OSError as e:
+                Logger.warning("Metrics: Cannot listen on %s:%d: %s", self.address, self.port, e)
+            else:
+                threading.Thread(target=self._httpd.serve_forever, name="MetricsServer", daemon=True).start()
+
+        if self.publish_interval and self.mqtt is not None:
+            self._publish_event = Clock.schedule_interval(self._publish, self.publish_interval)
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+        if self._publish_event is not None:
+            self._publish_event.cancel()
+            self._publish_event = None
+
+    def _publish(self, _dt):
+        self.mqtt.publish(self.topic, self.registry.render(), qos=0)
@@ -0,0 +1,181 @@
+"""Player backend that talks to MPD directly
+
+One persistent connection is kept on the asyncio loop the app runs on.
+Between commands the connection waits in "idle", so MPD pushes changes
+instead of being polled. Queued commands interrupt the idle and are sent
+together as one command list.
+"""
+
+import asyncio
+import os
+from collections import deque
+
+from kivy import Logger
+
+from playerbackend import PlayerBackend
+from store import PLAYER
+
+
+class MpdError(Exception):
+    pass
+
+
+class MpdPlayerBackend(PlayerBackend):
+    RECONNECT_DELAY = 5
+    CONNECT_TIMEOUT = 5
+
+    # player commands of the MQTT relay as MPD commands
+    COMMANDS = {
+        "play": ["single 0", "play"],
+        "pause": ["pause 1"],
+        "next": ["next"],
+        "stop after": ["single 1"],
+    }
+
+    def __init__(self, conf, on_field):
+        super(MpdPlayerBackend, self).__init__(conf, on_field)
+
+        self.pending = deque()
+        self._wake = asyncio.Event()
+        self._task = None
+        self._reader = None
+        self._writer = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def command(self, cmd):
+        lines = MpdPlayerBackend.COMMANDS.get(cmd)
+        if lines is None:
+            Logger.warning("MPD: Unknown command %s", cmd)
+            return
+
+        self.pending.extend(lines)
+        self._wake.set()
+
+    def set_volume(self, volume):
+        self.pending.append("setvol {:d}".format(volume))
+        self._wake.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await self._connect()
+                await self._refresh()
+                while True:
+                    await self._idle()
+            except (OSError, asyncio.TimeoutError, ConnectionError, MpdError) as e:
+                Logger.warning("MPD: Connection to %s:%d lost, will try again: %s",
+                               self.conf.mpd_host, self.conf.mpd_port, e)
+            except ValueError as e:
+                # a malformed response, UnicodeDecodeError is a ValueError as well
+                Logger.warning("MPD: Invalid response from %s:%d, will reconnect: %s",
+                               self.conf.mpd_host, self.conf.mpd_port, e)
+            finally:
+                if self._writer is not None:
+                    self._writer.close()
+                    self._writer = None
+
+            await asyncio.sleep(MpdPlayerBackend.RECONNECT_DELAY)
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.conf.mpd_host, self.conf.mpd_port),
+            MpdPlayerBackend.CONNECT_TIMEOUT)
+
+        greeting = await self._reader.readline()
+        if not greeting.startswith(b"OK MPD "):
+            raise MpdError("Unexpected greeting {!r}".format(greeting))
+
+        if self.conf.mpd_password:
+            await self._execute(["password {}".format(self._quote(self.conf.mpd_password))])
+
+        Logger.info("MPD: Connected to %s:%d", self.conf.mpd_host, self.conf.mpd_port)
+
+    async def _idle(self):
+        """Wait for a change or a command, then update the state"""
+        self._wake.clear()
+        if not self.pending:
+            self._writer.write(b"idle player mixer options\n")
+            response = asyncio.ensure_future(self._read_response())
+            wake = asyncio.ensure_future(self._wake.wait())
+            try:
+                await asyncio.wait({response, wake}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                wake.cancel()
+
+            # "noidle" ends the idle with an empty response
+            if not response.done():
+                self._writer.write(b"noidle\n")
+            await response
+
+        if self.pending:
+            commands = list(self.pending)
+            self.pending.clear()
+            try:
+                await self._execute(commands)
+            except MpdError as e:
+                Logger.warning("MPD: Command failed: %s", e)
+
+        await self._refresh()
+
+    async def _refresh(self):
+        status, song = await self._execute(["status", "currentsong"])
+
+        self.on_field(PLAYER.STATE, status.get("state", "stop"))
+        self.on_field(PLAYER.SINGLE, status.get("single", "0"))
+        # the volume is -1 or missing without a mixer
+        self.on_field(PLAYER.VOLUME, max(0, int(status.get("volume", 0))))
+        self.on_field(PLAYER.ARTIST, song.get("Artist", ""))
+        self.on_field(PLAYER.ALBUM, song.get("Album", ""))
+        self.on_field(PLAYER.TITLE, song.get("Title", song.get("file", "")))
+
+        if self.conf.music_dir and self.on_cover is not None and "file" in song:
+            self.on_cover(song.get("Album", ""), directory=os.path.join(self.conf.music_dir, os.path.dirname(song["file"])))
+
+    async def _execute(self, commands):
+        """Send commands in one go, return one dict of response values per command"""
+        if len(commands) == 1:
+            self._writer.write(commands[0].encode("utf-8") + b"\n")
+        else:
+            self._writer.write("command_list_ok_begin\n{}\ncommand_list_end\n".format(
+                "\n".join(commands)).encode("utf-8"))
+        await self._writer.drain()
+
+        responses = [dict()]
+        for item in await self._read_response():
+            if item is None:
+                responses.append(dict())
+            else:
+                responses[-1].setdefault(item[0], item[1])
+
+        return responses[:len(commands)]
+
+    async def _read_response(self):
+        """Read up to OK, list_OK is returned as None between the values of two commands"""
+        items = []
+        while True:
+            line = await self._reader.readline()
+            if not line:
+                raise ConnectionError("Connection closed by MPD")
+
+            line = line.decode("utf-8").rstrip("\n")
+            if line == "OK":
+                return items
+            if line.startswith("ACK "):
+                raise MpdError(line)
+            if line == "list_OK":
+                items.append(None)
+                continue
+
+            key, _, value = line.partition(": ")
+            items.append((key, value))
+
+    @staticmethod
+    def _quote(value):
+        return '"{}"'.format(value.replace("\\", "\\\\").replace('"', '\\"'))
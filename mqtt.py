@@ -1,13 +1,25 @@
 import socket
 import threading
+import time
+import uuid
+from collections import deque
 
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from paho.mqtt.subscribeoptions import SubscribeOptions
 
 from kivy import Logger
+from kivy.clock import Clock
 from kivy.lang import Builder
 from kivy.properties import ObjectProperty, StringProperty, ColorProperty
 from kivy.uix.relativelayout import RelativeLayout
 
+from metrics import REGISTRY
+from outbox import Outbox
+from profiler import SamplingProfiler
+from topics import TopicRouter, covering_filters
+
 Builder.load_string("""
 <MqttClient>:
     label: "MQTT"        
@@ -32,6 +44,32 @@ Builder.load_string("""
         color: root.icon_color
 """)
 
+MESSAGES_IN = REGISTRY.counter("smartpanel_mqtt_messages_received_total",
+                               "MQTT messages received")
+MESSAGES_OUT = REGISTRY.counter("smartpanel_mqtt_messages_published_total",
+                                "MQTT messages published")
+CONNECTS = REGISTRY.counter("smartpanel_mqtt_connects_total",
+                            "Connections to the MQTT broker, including reconnects")
+PENDING_PUBLISHES = REGISTRY.gauge("smartpanel_mqtt_pending_publishes",
+                                   "Published messages not yet handed to the broker")
+DISPATCH_LATENCY = REGISTRY.histogram("smartpanel_mqtt_dispatch_seconds",
+                                      "Time spent in MQTT message handlers")
+BROKER_SUBSCRIPTIONS = REGISTRY.gauge("smartpanel_mqtt_broker_subscriptions",
+                                      "Subscriptions held by the broker for consolidated topic filters")
+SAVED_SUBSCRIPTIONS = REGISTRY.gauge("smartpanel_mqtt_saved_subscriptions",
+                                     "Broker subscriptions saved by consolidating topic filters")
+ROUTE_TIME = REGISTRY.histogram("smartpanel_mqtt_route_seconds",
+                                "Time to match a message against the local topic filters",
+                                buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005))
+UNROUTED = REGISTRY.counter("smartpanel_mqtt_unrouted_messages_total",
+                            "Messages received for a consolidated filter that match no topic filter")
+PING_RTT = REGISTRY.gauge("smartpanel_mqtt_ping_rtt_seconds",
+                          "Round-trip time of the loopback ping, averaged over the last pings")
+PING_TIMEOUTS = REGISTRY.counter("smartpanel_mqtt_ping_timeouts_total",
+                                 "Connections reset because the loopback ping was not answered")
+ALIAS_BYTES_SAVED = REGISTRY.counter("smartpanel_mqtt_alias_bytes_saved_total",
+                                     "Topic bytes not sent thanks to MQTT v5 topic aliases")
+
 
 class MqttClient(RelativeLayout):
     cfg = ObjectProperty(None, allownone=True)
@@ -45,43 +83,197 @@ class MqttClient(RelativeLayout):
     icon = StringProperty(None)
     icon_color = ColorProperty([77 / 256, 77 / 256, 76 / 256, 1])
 
+    # seconds the icon must be held to dispatch on_long_press
+    LONG_PRESS = 1.0
+
+    __events__ = ('on_long_press',)
+
     def __init__(self, **kwargs):
         super(MqttClient, self).__init__(**kwargs)
 
         self.bind(cfg=self._on_cfg)
         self.bind(status=self._on_status)
 
+        # topic filter: ((cb, handler), ...), replaced on change so that it
+        # can be iterated without the lock
         self.subscriptions = dict()
 
+        # used instead of per-topic broker subscriptions when consolidating
+        self.router = TopicRouter()
+        self.broker_filters = set()
+        # topic filters the broker has sent the retained messages for
+        self.covered = set()
+        self._cover_trigger = Clock.create_trigger(self._update_cover)
+
+        # MQTT v5 topic aliases of the current connection
+        self.topic_aliases = dict()
+        self.topic_alias_maximum = 0
+
+        # application-level ping on a topic only this client uses
+        self.ping_topic = None
+        self.last_pong = time.monotonic()
+        self.ping_rtts = deque(maxlen=10)
+        self._ping_event = None
+
+        # commands issued while the broker cannot be reached
+        self.outbox = None
+        self._flush_trigger = None
+
         self.lock = threading.Lock()
 
+        self.profiler = None
+        self._long_press_event = None
+
     def __del__(self):
         self._disconnect()
 
     def _on_cfg(self, _instance, _value):
+        if self.cfg:
+            self.subscribe(self.cfg.mqtt.profile_topic, self._on_profile_cmd)
+
+            if self.outbox is None:
+                # with MQTT v5 a command must not be sent later than the broker would deliver it
+                max_age = self.cfg.mqtt.outbox_max_age
+                if self._is_v5():
+                    max_age = min(max_age, self.cfg.mqtt.command_expiry)
+                self.outbox = Outbox(max_size=self.cfg.mqtt.outbox_size,
+                                     max_age=max_age,
+                                     path=self.cfg.mqtt.outbox_file)
+                self._flush_trigger = Clock.create_trigger(self._flush_outbox, self.cfg.mqtt.outbox_pace)
+
         self._connect()
 
     def _on_status(self, _instance, _value):
         if self.status == "connected":
             self.icon_color = [0 / 256, 163 / 256, 86 / 256, 1]
+        elif self.status == "degraded":
+            self.icon_color = [255 / 256, 204 / 256, 0 / 256, 1]
         elif self.status == "disconnected":
             self.icon_color = [228 / 256, 5 / 256, 41 / 256, 1]
         else:
             self.icon_color = [77 / 256, 77 / 256, 76 / 256, 1]
 
-    def subscribe(self, topic, cb):
-        with self.lock:
-            self.subscriptions[topic] = cb
-            self._register_callback(topic, cb)
+    def on_touch_down(self, touch):
+        if self.collide_point(touch.pos[0], touch.pos[1]):
+            self._long_press_event = Clock.schedule_once(lambda dt: self.dispatch('on_long_press'),
+                                                         MqttClient.LONG_PRESS)
+            return True
+
+        return super(MqttClient, self).on_touch_down(touch)
+
+    def on_touch_up(self, touch):
+        if self._long_press_event is not None:
+            self._long_press_event.cancel()
+            self._long_press_event = None
+
+        return super(MqttClient, self).on_touch_up(touch)
 
-    def unsubscribe(self, topic):
+    def on_long_press(self):
+        pass
+
+    def subscribe(self, topic, cb, codec=None):
+        """Call cb(client, userdata, message) for messages on topic
+
+        With a codec from codec.py, cb(value) is called with the decoded
+        payload instead.
+        """
+        handler = cb if codec is None else codec.handler(cb)
+
+        with self.lock:
+            handlers = self.subscriptions.get(topic)
+            if handlers is not None:
+                self.subscriptions[topic] = handlers + ((cb, handler),)
+                # the new subscriber needs the retained message as well
+                if self._consolidating():
+                    self.covered.discard(topic)
+                    self._cover_trigger()
+                elif self.backend:
+                    self._broker_subscribe(topic, resend_retained=True)
+                return
+
+            self.subscriptions[topic] = ((cb, handler),)
+            self.router.add(topic, self._topic_dispatcher(topic))
+            if self._consolidating():
+                self._cover_trigger()
+            else:
+                self._register_callback(topic)
+
+    def unsubscribe(self, topic, cb=None):
+        """Stop calling cb for topic, without cb all callbacks of topic
+
+        The topic is unsubscribed at the broker once it has no callbacks.
+        """
         with self.lock:
-            if topic in self.subscriptions:
-                del self.subscriptions[topic]
+            handlers = self.subscriptions.get(topic)
+            if handlers is None:
+                return
+
+            remaining = tuple(h for h in handlers if cb is not None and h[0] != cb)
+            if remaining:
+                self.subscriptions[topic] = remaining
+                return
+
+            del self.subscriptions[topic]
+            self.router.remove(topic)
+            if self._consolidating():
+                # subscribed again later, it gets its retained messages again
+                self.covered.discard(topic)
+                self._cover_trigger()
+            elif self.backend:
+                self.backend.message_callback_remove(topic)
+                self.backend.unsubscribe(topic)
+
+    def publish(self, topic, payload, qos=2, expires=False, supersedes=False):
+        """Publish a message
+
+        Messages that expire are commands. While the broker cannot be
+        reached they wait in the outbox, and an MQTT v5 broker drops them if
+        they cannot be delivered within [MQTT] command_expiry seconds.
+        Commands that set a state supersede the pending command for the same
+        topic in the outbox, others are kept in order.
+        """
+        if expires and self.outbox is not None and not self._is_up():
+            self.outbox.put(topic, payload, qos, supersedes)
+            return
 
-    def publish(self, topic, payload, qos=2):
         if self.backend:
-            self.backend.publish(topic, payload, qos=qos)
+            properties = None
+            if self._is_v5():
+                properties = Properties(PacketTypes.PUBLISH)
+                if expires:
+                    properties.MessageExpiryInterval = self.cfg.mqtt.command_expiry
+                topic = self._alias_topic(topic, qos, properties)
+
+            # before publishing, paho may call on_publish before it returns
+            PENDING_PUBLISHES.inc()
+            info = self.backend.publish(topic, payload, qos=qos, properties=properties)
+            # without a connection paho keeps only messages with QoS > 0
+            if info.rc != mqtt.MQTT_ERR_SUCCESS and not (info.rc == mqtt.MQTT_ERR_NO_CONN and qos > 0):
+                PENDING_PUBLISHES.dec()
+                return
+            MESSAGES_OUT.inc()
+
+    def _alias_topic(self, topic, qos, properties):
+        """Replace the topic by an alias if possible, return the topic to send"""
+        # Messages with QoS > 0 are sent again after a reconnect with their
+        # properties, where the aliases are unknown, so they never use one
+        if qos > 0:
+            return topic
+
+        with self.lock:
+            alias = self.topic_aliases.get(topic)
+            if alias is None:
+                if len(self.topic_aliases) >= self.topic_alias_maximum:
+                    return topic
+                alias = len(self.topic_aliases) + 1
+                self.topic_aliases[topic] = alias
+                # the first publish sets the alias
+                properties.TopicAlias = alias
+                return topic
+
+        properties.TopicAlias = alias
+        ALIAS_BYTES_SAVED.inc(len(topic.encode("utf-8")))
+        return ""
 
     def _log_error(self, error):
         self.error = error
@@ -98,45 +290,244 @@ class MqttClient(RelativeLayout):
         if not self.cfg:
             self._disconnect()
 
-        host = self.cfg.get("MQTT", "host")
-        if not host:
-            self._log_error("Missing MQTT host configuration! See template for an example.")
-            return
+        host = self.cfg.mqtt.host
 
-        client = mqtt.Client()
+        if self.cfg.soak is not None:
+            # simulated devices instead of the broker
+            from soak import SimulatedBroker
+            client = SimulatedBroker(self.cfg)
+        else:
+            client = mqtt.Client(protocol=mqtt.MQTTv5 if self._is_v5() else mqtt.MQTTv311)
         client.on_connect = self._on_connect
         client.on_disconnect = self._on_disconnect
+        client.on_publish = self._on_publish
+        if self._consolidating():
+            client.on_message = self._on_message
+
+        self.ping_topic = "{}/{}".format(self.cfg.mqtt.ping_topic, uuid.uuid4().hex[:12])
+        client.message_callback_add(self.ping_topic, self._on_pong)
         try:
-            client.connect(host, 1883, 60)
+            client.connect(host, self.cfg.mqtt.port, self.cfg.mqtt.keepalive)
 
             client.loop_start()
 
             self.backend = client
+
+            if self._ping_event is not None:
+                self._ping_event.cancel()
+            if self.cfg.mqtt.ping_interval > 0:
+                self._ping_event = Clock.schedule_interval(self._ping, self.cfg.mqtt.ping_interval)
         except ConnectionRefusedError as e:
             self._log_error(f"Failed to connect to MQTT client, will try again: %s" % e)
         except socket.gaierror as e:
             self._log_error(f"Host not found, will try again: %s" % e)
 
-    def _on_connect(self, _backend, _userdata, _flags, rc):
+    def _on_connect(self, backend, _userdata, _flags, rc, properties=None):
         Logger.info("MQTT: Client connected with code %s", rc)
+        self.last_pong = time.monotonic()
         self.status = "connected"
+        CONNECTS.inc()
+
+        # not in the subscriptions, it must never be consolidated or use no-local
+        backend.subscribe(self.ping_topic)
+
+        if self.outbox:
+            self._flush_trigger()
+
+        # messages of the old connection are not acknowledged any more
+        PENDING_PUBLISHES.set(0)
 
         with self.lock:
-            for topic, cb in self.subscriptions.items():
-                self._register_callback(topic, cb)
+            # aliases are valid for one connection only
+            self.topic_aliases = dict()
+            self.topic_alias_maximum = getattr(properties, "TopicAliasMaximum", 0)
+
+            if self._consolidating():
+                self.broker_filters = set()
+                self.covered = set()
+                self._subscribe_cover()
+            else:
+                for topic in self.subscriptions:
+                    self._register_callback(topic)
 
     def _disconnect(self):
         if self.backend:
             self.backend.loop_stop()
 
-    def _on_disconnect(self, _backend, _userdata, rc):
+    @staticmethod
+    def _on_publish(_backend, _userdata, _mid):
+        # messages paho sends again after a reconnect were reset already
+        if PENDING_PUBLISHES.value > 0:
+            PENDING_PUBLISHES.dec()
+
+    def _on_disconnect(self, _backend, _userdata, rc, _properties=None):
         Logger.info("MQTT: Client disconnected with code %s", rc)
         self.status = "disconnected"
 
-    def _register_callback(self, topic, cb):
-        if self.backend:
+    def _is_up(self):
+        return self.backend is not None and self.status in ("connected", "degraded")
+
+    def _flush_outbox(self, _dt):
+        """Send one queued command, then wait for the next trigger"""
+        if not self._is_up():
+            return
+
+        command = self.outbox.pop()
+        if command is not None:
+            topic, payload, qos, supersedes = command
+            self.publish(topic, payload, qos=qos, expires=True, supersedes=supersedes)
+            self._flush_trigger()
+
+    def _ping(self, _dt):
+        if not self._is_up():
+            return
+
+        silent = time.monotonic() - self.last_pong
+        if silent > self.cfg.mqtt.disconnected_after:
+            self._reset_connection(silent)
+            return
+
+        self.status = "degraded" if silent > self.cfg.mqtt.degraded_after else "connected"
+        self.publish(self.ping_topic, repr(time.monotonic()), qos=0)
+
+    def _on_pong(self, _client, _userdata, message):
+        now = time.monotonic()
+        try:
+            self.ping_rtts.append(now - float(message.payload))
+        except ValueError:
+            return
+
+        self.last_pong = now
+        PING_RTT.set(sum(self.ping_rtts) / len(self.ping_rtts))
+        if self.status == "degraded":
+            self.status = "connected"
+
+    def _reset_connection(self, silent):
+        """Shut down a connection that no longer gets through, paho then reconnects"""
+        Logger.warning("MQTT: No ping response for %.1f s, resetting the connection", silent)
+        PING_TIMEOUTS.inc()
+        self.status = "disconnected"
+
+        sock = self.backend.socket() if self.backend else None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _is_v5(self):
+        return self.cfg is not None and self.cfg.mqtt.protocol == "5"
+
+    def _broker_subscribe(self, topic, resend_retained=False):
+        """Subscribe at the broker, resend_retained asks again for the retained messages of an existing subscription"""
+        if self._is_v5():
+            # Our own publishes are never of interest, and retained messages
+            # are only needed for new subscriptions or new subscribers, e.g.
+            # not when the consolidated filters are updated
+            self.backend.subscribe(topic, options=SubscribeOptions(
+                noLocal=True,
+                retainHandling=(SubscribeOptions.RETAIN_SEND_ON_SUBSCRIBE if resend_retained
+                                else SubscribeOptions.RETAIN_SEND_IF_NEW_SUB)))
+        else:
+            # a 3.1.1 broker resends the retained messages on every subscribe
             self.backend.subscribe(topic)
-            self.backend.message_callback_add(topic, cb)
+
+    def _register_callback(self, topic):
+        if self.backend:
+            self._broker_subscribe(topic)
+            self.backend.message_callback_add(topic, self._topic_dispatcher(topic))
+
+    def _topic_dispatcher(self, topic):
+        """Call the handlers of all subscribers of topic"""
+        def dispatch(client, userdata, message):
+            for _cb, handler in self.subscriptions.get(topic, ()):
+                handler(client, userdata, message)
+
+        return MqttClient._instrumented(dispatch)
+
+    def _consolidating(self):
+        return self.cfg is not None and self.cfg.mqtt.consolidate
+
+    def _update_cover(self, _dt):
+        with self.lock:
+            self._subscribe_cover()
+
+    def _subscribe_cover(self):
+        """Bring the broker subscriptions in line with the covering filters, the lock must be held"""
+        if not self.backend:
+            return
+
+        cover = covering_filters(self.subscriptions, self.cfg.mqtt.consolidate_min)
+
+        # filters that are kept but cover new topics are subscribed again,
+        # so that the broker sends the retained messages of the new topics
+        added = set(self.subscriptions) - self.covered
+        resubscribe = {f for f in cover & self.broker_filters
+                       if any(f == topic or mqtt.topic_matches_sub(f, topic) for topic in added)}
+        self.covered = set(self.subscriptions)
+        if cover == self.broker_filters and not resubscribe:
+            return
+
+        # subscribe first, so that no message falls into a gap
+        for topic_filter in cover - self.broker_filters:
+            self._broker_subscribe(topic_filter)
+        for topic_filter in resubscribe:
+            self._broker_subscribe(topic_filter, resend_retained=True)
+        for topic_filter in self.broker_filters - cover:
+            self.backend.unsubscribe(topic_filter)
+        self.broker_filters = cover
+
+        BROKER_SUBSCRIPTIONS.set(len(cover))
+        SAVED_SUBSCRIPTIONS.set(len(self.subscriptions) - len(cover))
+        Logger.info("MQTT: %d broker subscriptions cover %d topic filters",
+                    len(cover), len(self.subscriptions))
+
+    def _on_message(self, client, userdata, message):
+        start = time.perf_counter()
+        with self.lock:
+            callbacks = self.router.route(message.topic)
+        ROUTE_TIME.observe(time.perf_counter() - start)
+
+        if not callbacks:
+            UNROUTED.inc()
+        for cb in callbacks:
+            cb(client, userdata, message)
+
+    @staticmethod
+    def _instrumented(cb):
+        def dispatch(client, userdata, message):
+            MESSAGES_IN.inc()
+            start = time.perf_counter()
+            try:
+                cb(client, userdata, message)
+            finally:
+                DISPATCH_LATENCY.observe(time.perf_counter() - start)
+
+        return dispatch
+
+    def _on_profile_cmd(self, _client, _userdata, message):
+        # a retained command would start a profile on every connect
+        if message.retain:
+            return
+
+        if self.profiler is not None and self.profiler.is_running():
+            Logger.info("MQTT: Profiler is already running")
+            return
+
+        try:
+            duration = min(float(message.payload or 10), self.cfg.mqtt.profile_max_duration)
+        except ValueError:
+            self._log_error("Invalid profile duration: %s" % message.payload)
+            return
+
+        Logger.info("MQTT: Profiling for %.1f s", duration)
+        self.profiler = SamplingProfiler(duration=duration,
+                                         output_dir=self.cfg.mqtt.profile_dir,
+                                         on_done=self._on_profile_done)
+        self.profiler.start()
+
+    def _on_profile_done(self, profiler):
+        self.publish(self.cfg.mqtt.profile_result_topic, profiler.summary(), qos=1)
 
     @staticmethod
     def topic_matches_sub(sub, topic):
@@ -0,0 +1,106 @@
+"""Queue for commands issued while the broker cannot be reached
+
+Commands that set a state, e.g. the power of a Thing, supersede: there is
+at most one of them pending per topic, two toggles cancel each other out,
+a toggle turns a pending ON into OFF and vice versa, and any other command
+replaces the pending one, so that only the net result is sent once the
+connection is back. All other commands, e.g. of
+the player, are sent in the order they were issued.
+"""
+
+import json
+import os
+import time
+
+from kivy import Logger
+
+from metrics import REGISTRY
+
+DEPTH = REGISTRY.gauge("smartpanel_outbox_depth",
+                       "Commands waiting for the connection to the broker")
+SUPERSEDED = REGISTRY.counter("smartpanel_outbox_superseded_total",
+                              "Queued commands replaced or cancelled by a newer command")
+DROPPED = REGISTRY.counter("smartpanel_outbox_dropped_total",
+                           "Queued commands dropped because the outbox was full or they got too old")
+
+
+class Outbox:
+    TOGGLES = ("TOGGLE", "toggle")
+    # explicit state: the state a toggle after it results in
+    INVERTED = {"ON": "OFF", "OFF": "ON", "on": "off", "off": "on"}
+
+    def __init__(self, max_size=32, max_age=300, path=None):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.path = path
+
+        # (topic, payload, qos, wall clock time of the command, supersedes), oldest first
+        self.entries = []
+
+        self._load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, topic, payload, qos, supersedes=False):
+        if supersedes:
+            pending = next((e for e in self.entries if e[0] == topic and e[4]), None)
+            if pending is not None:
+                self.entries.remove(pending)
+                SUPERSEDED.inc()
+                if payload in Outbox.TOGGLES:
+                    if pending[1] in Outbox.TOGGLES:
+                        self._changed()
+                        return
+                    payload = Outbox.INVERTED.get(pending[1], payload)
+
+        self.entries.append((topic, payload, qos, time.time(), supersedes))
+        while len(self.entries) > self.max_size:
+            del self.entries[0]
+            DROPPED.inc()
+
+        self._changed()
+
+    def pop(self):
+        """Remove and return the oldest command as (topic, payload, qos, supersedes), None if there is none"""
+        command = None
+        while self.entries and command is None:
+            topic, payload, qos, created, supersedes = self.entries.pop(0)
+            if time.time() - created <= self.max_age:
+                command = (topic, payload, qos, supersedes)
+            else:
+                DROPPED.inc()
+
+        self._changed()
+        return command
+
+    def _changed(self):
+        DEPTH.set(len(self.entries))
+        self._save()
+
+    def _load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path) as f:
+                for topic, payload, qos, created, supersedes in json.load(f):
+                    self.entries.append((topic, payload, qos, created, supersedes))
+        except (OSError, ValueError, TypeError) as e:
+            Logger.warning("Outbox: Ignoring %s: %s", self.path, e)
+            self.entries.clear()
+
+        DEPTH.set(len(self.entries))
+
+    def _save(self):
+        if self.path is None:
+            return
+
+        # replace the file in one step, so that a crash leaves the old or the new queue
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            Logger.warning("Outbox: Cannot write %s: %s", self.path, e)
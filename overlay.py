@@ -0,0 +1,129 @@
+"""On-screen performance overlay for field debugging"""
+
+from collections import deque
+
+from kivy.clock import Clock
+from kivy.core.text import Label as CoreLabel
+from kivy.graphics import Color, Rectangle
+from kivy.properties import BooleanProperty, NumericProperty, ObjectProperty
+from kivy.uix.widget import Widget
+
+from color import RMColor
+from mqtt import MESSAGES_IN, PENDING_PUBLISHES
+from startup import rss_bytes
+
+
+class GlyphCache:
+    """Textures for single characters, rendered once per font and size"""
+    def __init__(self, font_name, font_size):
+        self.font_name = font_name
+        self.font_size = font_size
+        self.textures = dict()
+
+    def get(self, ch):
+        texture = self.textures.get(ch)
+        if texture is None:
+            label = CoreLabel(text=ch, font_name=self.font_name, font_size=self.font_size)
+            label.refresh()
+            texture = label.texture
+            self.textures[ch] = texture
+        return texture
+
+
+class PerfOverlay(Widget):
+    cfg = ObjectProperty(None)
+    visible = BooleanProperty(False)
+    # seconds to look back for the worst frame time
+    window = NumericProperty(10)
+
+    LINES = 5
+    COLUMNS = 16
+
+    glyphs = None
+
+    def __init__(self, **kwargs):
+        super(PerfOverlay, self).__init__(**kwargs)
+
+        if PerfOverlay.glyphs is None:
+            PerfOverlay.glyphs = GlyphCache('resources/FiraMono-Regular.ttf', 12)
+
+        self.frame_max = deque(maxlen=int(self.window))
+        self.current_max = 0
+        self.last_messages = MESSAGES_IN.value
+
+        self._frame_event = None
+        self._refresh_event = None
+
+        # One rectangle per character cell, the texture is swapped on refresh
+        self.cells = []
+        with self.canvas:
+            self.color = Color(rgba=RMColor.get_rgba("yellow", alpha=0))
+            for _ in range(PerfOverlay.LINES * PerfOverlay.COLUMNS):
+                self.cells.append(Rectangle(size=(0, 0)))
+
+        self.bind(pos=self._on_pos)
+        self._on_pos(self, self.pos)
+
+    def on_cfg(self, _instance, _value):
+        if self.cfg:
+            self.visible = self.cfg.overlay.enabled
+            self.window = self.cfg.overlay.window
+
+    def on_window(self, _instance, _value):
+        self.frame_max = deque(self.frame_max, maxlen=max(1, int(self.window)))
+
+    def on_visible(self, _instance, _value):
+        if self.visible:
+            self.frame_max.clear()
+            self.current_max = 0
+            self.last_messages = MESSAGES_IN.value
+            self._frame_event = Clock.schedule_interval(self._on_frame, 0)
+            self._refresh_event = Clock.schedule_interval(self._refresh, 1)
+            self.color.a = 1
+        else:
+            if self._frame_event is not None:
+                self._frame_event.cancel()
+                self._refresh_event.cancel()
+                self._frame_event = None
+                self._refresh_event = None
+            self.color.a = 0
+
+    def _on_pos(self, _instance, _value):
+        advance = self.glyphs.get("0").width
+        line_height = self.glyphs.get("0").height
+        for i, cell in enumerate(self.cells):
+            line, col = divmod(i, PerfOverlay.COLUMNS)
+            cell.pos = (self.x + col * advance,
+                        self.y + (PerfOverlay.LINES - line - 1) * line_height)
+
+    def _on_frame(self, dt):
+        if dt > self.current_max:
+            self.current_max = dt
+
+    def _refresh(self, dt):
+        self.frame_max.append(self.current_max)
+        self.current_max = 0
+
+        messages = MESSAGES_IN.value
+        rate = (messages - self.last_messages) / dt
+        self.last_messages = messages
+
+        self._show([
+            "FPS {:6.1f}".format(Clock.get_fps()),
+            "max {:6.1f} ms".format(1000 * max(self.frame_max)),
+            "MQTT {:5.1f}/s".format(rate),
+            "queue {:5d}".format(PENDING_PUBLISHES.value),
+            "RSS {:6.1f} MB".format(rss_bytes() / 1048576),
+        ])
+
+    def _show(self, lines):
+        for line in range(PerfOverlay.LINES):
+            text = lines[line] if line < len(lines) else ""
+            for col in range(PerfOverlay.COLUMNS):
+                cell = self.cells[line * PerfOverlay.COLUMNS + col]
+                if col < len(text) and text[col] != " ":
+                    texture = self.glyphs.get(text[col])
+                    cell.texture = texture
+                    cell.size = texture.size
+                else:
+                    cell.size = (0, 0)
@@ -0,0 +1,230 @@
+"""Paged layout for devices
+
+Every configured device has a lightweight state object that is fed by MQTT,
+but only the devices on the visible page have a widget.
+"""
+
+from kivy.lang import Builder
+from kivy.properties import NumericProperty, ObjectProperty
+from kivy.uix.relativelayout import RelativeLayout
+
+from scene import Scene, SceneButton
+from settings import SceneSettings, ShellySettings, TasmotaSettings
+from shelly import ShellyButton, ShellyDevice
+from tasmota import TasmotaDevice
+from thing import Thing
+
+Builder.load_string('''
+<DevicePager>:
+    size_hint: (None, None)
+
+    canvas.before:
+        # Device pages hide the home page
+        Color:
+            rgba: (0, 0, 0, 1 if root.page else 0)
+        Rectangle:
+            size: self.size
+
+    Label:
+        text: "{} / {}".format(root.page, root.page_count - 1) if root.page else ""
+        font_size: 16
+        size_hint: (None, None)
+        size: (root.size[0], 24)
+        pos: (0, 0)
+''')
+
+
+class DeviceSlot:
+    __slots__ = ("section", "kind", "device", "page", "pos", "widget")
+
+    def __init__(self, section, kind, device):
+        self.section = section
+        self.kind = kind
+        self.device = device
+        self.page = 0
+        self.pos = (0, 0)
+        self.widget = None
+
+
+class DevicePager(RelativeLayout):
+    cfg = ObjectProperty(None)
+    mqtt = ObjectProperty(None)
+
+    page = NumericProperty(0)
+    page_count = NumericProperty(1)
+
+    # settings class: (widget class, device class, widget size)
+    KINDS = {
+        TasmotaSettings: (Thing, TasmotaDevice, (300, 80)),
+        ShellySettings: (ShellyButton, ShellyDevice, (100, 150)),
+        SceneSettings: (SceneButton, Scene, (100, 100)),
+    }
+
+    MARGIN = 10
+    SWIPE_DISTANCE = 100
+
+    def __init__(self, **kwargs):
+        super(DevicePager, self).__init__(**kwargs)
+
+        self.slots = []
+        self.pages = dict()
+
+    def on_cfg(self, _instance, _value):
+        self._setup()
+
+    def on_mqtt(self, _instance, _value):
+        self._setup()
+
+    def _setup(self):
+        if self.cfg is None or self.mqtt is None or self.slots:
+            return
+
+        for section in self.cfg.devices:
+            self.slots.append(self._create_slot(section))
+
+        self._layout()
+        self._materialize(self.page)
+
+    def reload(self, sections):
+        """Rebuild the devices of the given sections after they have changed in the configuration
+
+        Devices of other sections keep their state and subscriptions, their
+        widgets are only rebuilt if they have moved.
+        """
+        if self.cfg is None or self.mqtt is None:
+            return
+
+        # all old devices are closed before new ones subscribe, a renamed
+        # section may keep the topics of the old one
+        for slot in [s for s in self.slots if s.section in sections]:
+            self._remove_slot(slot)
+        for section in sections:
+            if section in self.cfg.devices:
+                self.slots.append(self._create_slot(section))
+
+        order = {section: idx for idx, section in enumerate(self.cfg.devices)}
+        self.slots.sort(key=lambda s: order[s.section])
+
+        self._layout()
+
+        page = min(self.page, self.page_count - 1)
+        for slot in self.slots:
+            if slot.widget is not None and (slot.page != page or tuple(slot.widget.pos) != slot.pos):
+                self._dematerialize_slot(slot)
+        self.page = page
+        self._materialize(self.page)
+
+    def _create_slot(self, section):
+        conf = self.cfg.devices[section]
+        kind = type(conf)
+        return DeviceSlot(section, kind, DevicePager.KINDS[kind][1](conf, self.mqtt))
+
+    def _remove_slot(self, slot):
+        self._dematerialize_slot(slot)
+        slot.device.close()
+        self.slots.remove(slot)
+
+    def _layout(self):
+        auto = []
+        last_page = 0
+        for slot in self.slots:
+            conf = self.cfg.devices[slot.section]
+            if conf.pos is not None:
+                slot.page = conf.page
+                slot.pos = conf.pos
+                last_page = max(last_page, slot.page)
+            else:
+                auto.append(slot)
+
+        self._place(auto, last_page + 1)
+
+        self.pages = dict()
+        for slot in self.slots:
+            self.pages.setdefault(slot.page, []).append(slot)
+        self.page_count = max(self.pages.keys(), default=0) + 1
+
+    def _place(self, slots, page):
+        """Flow devices without a position onto pages, left to right and top to bottom"""
+        x = DevicePager.MARGIN
+        top = self.height - DevicePager.MARGIN
+        row_height = 0
+        for slot in slots:
+            w, h = DevicePager.KINDS[slot.kind][2]
+            if x + w > self.width:
+                x = DevicePager.MARGIN
+                top -= row_height + DevicePager.MARGIN
+                row_height = 0
+            if top - h < DevicePager.MARGIN:
+                page += 1
+                x = DevicePager.MARGIN
+                top = self.height - DevicePager.MARGIN
+                row_height = 0
+
+            slot.page = page
+            slot.pos = (x, top - h)
+            x += w + DevicePager.MARGIN
+            row_height = max(row_height, h)
+
+    def _materialize(self, page):
+        for slot in self.pages.get(page, []):
+            if slot.widget is None:
+                slot.widget = DevicePager.KINDS[slot.kind][0](cfg_name=slot.section,
+                                                              cfg=self.cfg,
+                                                              mqtt=self.mqtt,
+                                                              device=slot.device,
+                                                              pos=slot.pos)
+                self.add_widget(slot.widget)
+
+    def _dematerialize(self, page):
+        for slot in self.pages.get(page, []):
+            self._dematerialize_slot(slot)
+
+    def _dematerialize_slot(self, slot):
+        if slot.widget is not None:
+            slot.widget.release()
+            self.remove_widget(slot.widget)
+            slot.widget = None
+
+    def show_page(self, page):
+        page = max(0, min(page, self.page_count - 1))
+        if page == self.page:
+            return
+
+        self._dematerialize(self.page)
+        self.page = page
+        self._materialize(self.page)
+
+    def begin_swipe(self, touch):
+        touch.grab(self)
+        touch.ud['pager_start'] = touch.pos
+
+    def on_touch_down(self, touch):
+        if not self.collide_point(touch.pos[0], touch.pos[1]):
+            return False
+
+        if super(DevicePager, self).on_touch_down(touch):
+            return True
+
+        # The home page leaves touches to the widgets below
+        if not self.page:
+            return False
+
+        self.begin_swipe(touch)
+        return True
+
+    def on_touch_up(self, touch):
+        if touch.grab_current is not self:
+            return super(DevicePager, self).on_touch_up(touch)
+
+        touch.ungrab(self)
+        start = touch.ud.get('pager_start')
+        if start is None:
+            return True
+
+        dx = touch.pos[0] - start[0]
+        dy = touch.pos[1] - start[1]
+        if abs(dx) > DevicePager.SWIPE_DISTANCE and abs(dx) > abs(dy):
+            # swipe left for the next page
+            self.show_page(self.page + (1 if dx < 0 else -1))
+
+        return True
@@ -1,11 +1,24 @@
 from kivy.lang import Builder
 from kivy.uix.relativelayout import RelativeLayout
-from kivy.properties import ListProperty, StringProperty, ObjectProperty
+from kivy.properties import ListProperty, StringProperty, ObjectProperty, NumericProperty, BooleanProperty
 from kivy.clock import Clock
 
+from time import monotonic
+
 from color import RMColor
+from cover import CoverLoader
+from metrics import REGISTRY
+from mpd import MpdPlayerBackend
+from playerbackend import MqttPlayerBackend
+from store import STORE, PLAYER
+
+FEEDBACK_LATENCY = REGISTRY.histogram("smartpanel_player_feedback_seconds",
+                                      "Time from a player command to the first state report",
+                                      buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
 
 Builder.load_string('''
+#:import MarqueeLabel marquee.MarqueeLabel
+
 <PlayerWidget>:
     size: (470, 190)
     size_hint: (None, None)
@@ -26,59 +39,67 @@ Builder.load_string('''
             width: 1.5
             cap: 'none'
 
+    # Album cover, the song labels move right when it is shown
+    Image:
+        texture: root.cover_texture
+        size: (root.COVER_SIZE, root.COVER_SIZE)
+        size_hint: (None, None)
+        pos: (10, root.size[1]-75)
+        opacity: 1 if root.cover_texture else 0
+
     # Song Artist
     Image:
         source: 'resources/song_artist.png'
         size: (24, 24)
         size_hint: (None, None)
-        pos: (10, root.size[1]-36)
+        pos: (10 + root.cover_shift, root.size[1]-36)
         color: root.meta_color
 
-    Label:
+    MarqueeLabel:
         text: root.song_artist
         font_size: 20
-        size: (210, 24)
-        text_size: self.size
-        pos: (40, root.size[1]-36)
+        size: (210 - root.cover_shift / 2, 24)
+        pos: (40 + root.cover_shift, root.size[1]-36)
         size_hint: (None, None)
         color: root.meta_color
-        shorten: True
+        scroll: root.marquee
+        paused: root.marquee_paused
 
     # Song Album
     Image:
         source: 'resources/song_album.png'
         size: (24, 24)
         size_hint: (None, None)
-        pos: (255, root.size[1]-36)
+        pos: (255 + root.cover_shift / 2, root.size[1]-36)
         color: root.meta_color
 
-    Label:
+    MarqueeLabel:
         text: root.song_album
         font_size: 20
-        size: (180, 24)
-        text_size: self.size
-        pos: (285, root.size[1]-36)
+        size: (180 - root.cover_shift / 2, 24)
+        pos: (285 + root.cover_shift / 2, root.size[1]-36)
         size_hint: (None, None)
         color: root.meta_color
-        shorten: True
+        scroll: root.marquee
+        paused: root.marquee_paused
 
     # Song Title
     Image:
         source: 'resources/song_title.png'
         size: (24, 24)
         size_hint: (None, None)
-        pos: (10, root.size[1]-69)
+        pos: (10 + root.cover_shift, root.size[1]-69)
         color: root.meta_color
 
-    Label:
+    MarqueeLabel:
         text: root.song_title
         font_size: 20
-        size: (415, 24)
-        text_size: self.size
-        pos: (40, root.size[1]-69)
+        size: (415 - root.cover_shift, 24)
+        pos: (40 + root.cover_shift, root.size[1]-69)
         size_hint: (None, None)
         color: root.meta_color
-        shorten: True
+        scroll: root.marquee
+        paused: root.marquee_paused
 
     # Controls
     Image:
@@ -138,87 +159,127 @@ class PlayerWidget(RelativeLayout):
     cfg = ObjectProperty(None)
     mqtt = ObjectProperty(None)
 
-    topic_base = StringProperty(None)
+    # settings of the [Player] section
+    conf = ObjectProperty(None, allownone=True)
+
+    # scroll long song metadata, paused while the backlight is off
+    marquee = BooleanProperty(False)
+    marquee_paused = BooleanProperty(False)
+
+    cover_texture = ObjectProperty(None, allownone=True)
+    cover_shift = NumericProperty(0)
+
+    COVER_SIZE = 70
 
     def __init__(self, **kwargs):
         super(PlayerWidget, self).__init__(**kwargs)
 
-        self.metadata = dict()
-        self._set_metadata('state', 'stop')
-        self._set_metadata('single', '0')
-        self._set_metadata('volume', 0)
-        self._set_metadata('artist', "<Artist>")
-        self._set_metadata('album', "<Album>")
-        self._set_metadata('title', "<Title>")
+        # time of the last command without a report yet
+        self.command_sent = None
+
+        self.metadata = STORE.record("Player", PLAYER)
+        self._set_metadata(PLAYER.STATE, 'stop')
+        self._set_metadata(PLAYER.SINGLE, '0')
+        self._set_metadata(PLAYER.VOLUME, 0)
+        self._set_metadata(PLAYER.ARTIST, "<Artist>")
+        self._set_metadata(PLAYER.ALBUM, "<Album>")
+        self._set_metadata(PLAYER.TITLE, "<Title>")
 
         self.volume_levels = [0, 61, 74, 78, 83, 87, 91, 94, 97, 100]
 
         # True if the last action has resulted in a report back
         self.state_is_reported = False
 
+        self.backend = None
+        self.covers = None
+        # album of the shown or requested cover
+        self.cover_album = None
+
+        # what has been rendered, to skip unchanged state
+        self.version_shown = None
+        self.reported_shown = None
+
         Clock.schedule_interval(self._player_ui_state, 0.2)
 
     def on_cfg(self, _instance, _value):
-        self.topic_base = self.cfg.get('Player', "topic")
+        self.conf = self.cfg.player if self.cfg else None
+        self.marquee = self.conf.marquee if self.conf else False
         self.on_mqtt(self, self.mqtt)
 
     def on_mqtt(self, _instance, _value):
-        if self.topic_base is None or self.mqtt is None:
+        if self.conf is None or self.mqtt is None:
             return
 
-        self.mqtt.subscribe(self.topic_base + "/song/#",
-                            self.on_song_state)
-        self.mqtt.subscribe(self.topic_base + "/player/#",
-                            self.on_player_state)
-
-        # query the state
-        self.mqtt.publish(self.topic_base + "/CMD", "query", qos=2)
-
-    def _set_metadata(self, key, value):
-        self.metadata[key] = value
-        self.state_is_reported = True
+        if self.backend is not None:
+            self.backend.close()
 
-    def _get_metadata(self, key, default=None):
-        return self.metadata[key] if key in self.metadata.keys() else default
+        if self.conf.backend == "mpd":
+            self.backend = MpdPlayerBackend(self.conf, self._set_metadata)
+        else:
+            self.backend = MqttPlayerBackend(self.conf, self._set_metadata, self.mqtt)
+        if self.covers is None and self.conf.cover_cache_kb:
+            self.covers = CoverLoader(PlayerWidget.COVER_SIZE, 1024 * self.conf.cover_cache_kb)
+        self.backend.on_cover = self._on_cover
+        self.backend.start()
+
+    def _on_cover(self, album, data=None, directory=None):
+        # the MQTT backend calls from the network thread
+        Clock.schedule_once(lambda dt: self._request_cover(album, data, directory))
+
+    def _request_cover(self, album, data, directory):
+        if self.covers is None:
+            return
 
-    def on_song_state(self, _client, _userdata, message):
-        topic = message.topic
-        payload = message.payload.decode("utf-8")
+        def on_done(texture):
+            # ignore covers that arrive after the album has changed
+            if album == self.cover_album:
+                self._show_cover(texture)
 
-        if self.mqtt.topic_matches_sub(self.topic_base + "/song/artist", topic):
-            self._set_metadata('artist', payload)
+        self.covers.request(album, on_done, data=data, directory=directory)
 
-        if self.mqtt.topic_matches_sub(self.topic_base + "/song/album", topic):
-            self._set_metadata('album', payload)
+    def _update_cover_album(self, album):
+        if self.covers is not None and album != self.cover_album:
+            self.cover_album = album
+            self._show_cover(self.covers.cached(album))
 
-        if self.mqtt.topic_matches_sub(self.topic_base + "/song/title", topic):
-            self._set_metadata('title', payload)
+    def _show_cover(self, texture):
+        self.cover_texture = texture
+        self.cover_shift = PlayerWidget.COVER_SIZE + 10 if texture is not None else 0
 
-    def on_player_state(self, _client, _userdata, message):
-        topic = message.topic
-        payload = message.payload.decode("utf-8")
+    def _set_metadata(self, field, value):
+        self.metadata.set(field, value)
+        self.state_is_reported = True
 
-        if self.mqtt.topic_matches_sub(self.topic_base + "/player/state", topic):
-            self._set_metadata('state', payload)
+        if self.command_sent is not None:
+            FEEDBACK_LATENCY.observe(monotonic() - self.command_sent)
+            self.command_sent = None
 
-        if self.mqtt.topic_matches_sub(self.topic_base + "/player/single", topic):
-            self._set_metadata('single', payload)
+    def _command_sent(self):
+        self.state_is_reported = False
+        self.command_sent = monotonic()
 
-        if self.mqtt.topic_matches_sub(self.topic_base + "/player/volume", topic):
-            self._set_metadata('volume', int(payload))
+    def _get_metadata(self, field, default=None):
+        value = self.metadata.get(field)
+        return default if value is None else value
 
     def _player_ui_state(self, _dt):
-        self.song_artist = self._get_metadata('artist')
-        self.song_album = self._get_metadata('album')
-        self.song_title = self._get_metadata('title')
+        if self.metadata.version == self.version_shown and self.state_is_reported == self.reported_shown:
+            return
+        self.version_shown = self.metadata.version
+        self.reported_shown = self.state_is_reported
+
+        self.song_artist = self._get_metadata(PLAYER.ARTIST)
+        self.song_album = self._get_metadata(PLAYER.ALBUM)
+        self._update_cover_album(self.song_album)
+        self.song_title = self._get_metadata(PLAYER.TITLE)
 
         self.meta_color = RMColor.get_rgba(
-            "light blue" if self._get_metadata('state') == "play" else "reboot")
+            "light blue" if self._get_metadata(PLAYER.STATE) == "play" else "reboot")
 
-        if not self._get_metadata('state') == "play":
+        if not self._get_metadata(PLAYER.STATE) == "play":
             self.player_control_source = "resources/song_play.png"
         else:
-            if self._get_metadata('single') == "0":
+            if self._get_metadata(PLAYER.SINGLE) == "0":
                 self.player_control_source = "resources/song_stopnext.png"
             else:
                 self.player_control_source = "resources/song_stop.png"
@@ -228,7 +289,7 @@ class PlayerWidget(RelativeLayout):
         else:
             self.ctrl_color = RMColor.get_rgba("reboot")
 
-        self.volume_text = str(self._get_metadata('volume', '---'))
+        self.volume_text = str(self._get_metadata(PLAYER.VOLUME, '---'))
 
     def on_touch_down(self, touch):
         if self.collide_point(touch.pos[0], touch.pos[1]):
@@ -258,45 +319,42 @@ class PlayerWidget(RelativeLayout):
             return super(PlayerWidget, self).on_touch_down(touch)
 
     def on_main_control(self):
-        if self.topic_base is None or self.mqtt is None:
+        if self.backend is None:
             return
 
-        if not self._get_metadata('state') == "play":
+        if not self._get_metadata(PLAYER.STATE) == "play":
             cmd = "play"
         else:
-            if self._get_metadata('single') == "0":
+            if self._get_metadata(PLAYER.SINGLE) == "0":
                 cmd = "stop after"
             else:
                 cmd = "pause"
 
-        self.mqtt.publish(self.topic_base + "/CMD", cmd, qos=2)
-
-        self.state_is_reported = False
+        self._command_sent()
+        self.backend.command(cmd)
 
     def on_forward_control(self):
-        if self.topic_base is None or self.mqtt is None:
+        if self.backend is None:
             return
 
-        self.mqtt.publish(self.topic_base + "/CMD", "next", qos=2)
+        self._command_sent()
+        self.backend.command("next")
         # call "play" so reset "single play" status
-        self.mqtt.publish(self.topic_base + "/CMD", "play", qos=2)
-
-        self.state_is_reported = False
+        self.backend.command("play")
 
     def on_adjust_volume(self, up):
-        if self.topic_base is None or self.mqtt is None:
+        if self.backend is None:
             return
 
-        vol = min(self.volume_levels, key=lambda x: abs(x - self._get_metadata('volume', 0)))
+        vol = min(self.volume_levels, key=lambda x: abs(x - self._get_metadata(PLAYER.VOLUME, 0)))
         idx = self.volume_levels.index(vol)
 
         idx += 1 if up else -1
         idx = max(idx, 0)
         idx = min(idx, len(self.volume_levels) - 1)
 
-        self.mqtt.publish(self.topic_base + "/CMD/volume", str(self.volume_levels[idx]), qos=2)
-
-        self.state_is_reported = False
+        self._command_sent()
+        self.backend.set_volume(self.volume_levels[idx])
 
 
 Builder.load_string('''
@@ -348,5 +406,5 @@ class FavButtonWidget(RelativeLayout):
             return super(FavButtonWidget, self).on_touch_down(touch)
 
     def on_play_fav(self):
-        if self.mqtt and self.cfg:
-            self.mqtt.publish(self.cfg.get('Player', "topic") + "/CMD", "fav", qos=2)
+        if self.mqtt and self.cfg and self.cfg.player and self.cfg.player.cmd_topic:
+            self.mqtt.publish(self.cfg.player.cmd_topic, "fav", qos=2, expires=True)
@@ -0,0 +1,86 @@
+"""Backends that connect the player widget to the music player
+
+A backend sends the player commands and reports the player state field by
+field to a callback, with the PLAYER fields of the device store. Covers are
+reported to on_cover, either as image data or as the directory of the song.
+"""
+
+from codec import INT, TEXT
+from store import PLAYER
+
+
+class PlayerBackend:
+    def __init__(self, conf, on_field):
+        self.conf = conf
+        self.on_field = on_field
+        # on_cover(album, data=None, directory=None), album is the cache key
+        self.on_cover = None
+
+    def start(self):
+        """Connect to the player and query the current state"""
+        raise NotImplementedError()
+
+    def close(self):
+        raise NotImplementedError()
+
+    def command(self, cmd):
+        """Send a command: play, pause, next or stop after"""
+        raise NotImplementedError()
+
+    def set_volume(self, volume):
+        raise NotImplementedError()
+
+
+class MqttPlayerBackend(PlayerBackend):
+    """Talk to a relay that maps <topic>/CMD to the player and echoes its state"""
+
+    def __init__(self, conf, on_field, mqttc):
+        super(MqttPlayerBackend, self).__init__(conf, on_field)
+        self.mqtt = mqttc
+
+        # incoming topic: (field, codec), the topics arrive on two wildcard filters
+        self.fields = {conf.artist_topic: (PLAYER.ARTIST, TEXT),
+                       conf.album_topic: (PLAYER.ALBUM, TEXT),
+                       conf.title_topic: (PLAYER.TITLE, TEXT),
+                       conf.state_topic: (PLAYER.STATE, TEXT),
+                       conf.single_topic: (PLAYER.SINGLE, TEXT),
+                       conf.volume_topic: (PLAYER.VOLUME, INT)}
+        # album of the covers that arrive
+        self.album = None
+
+    def start(self):
+        self.mqtt.subscribe(self.conf.song_filter, self._on_message)
+        self.mqtt.subscribe(self.conf.player_filter, self._on_message)
+
+        # query the state
+        self.mqtt.publish(self.conf.cmd_topic, "query", qos=2)
+
+    def close(self):
+        self.mqtt.unsubscribe(self.conf.song_filter, self._on_message)
+        self.mqtt.unsubscribe(self.conf.player_filter, self._on_message)
+
+    def command(self, cmd):
+        self.mqtt.publish(self.conf.cmd_topic, cmd, qos=2, expires=True)
+
+    def set_volume(self, volume):
+        self.mqtt.publish(self.conf.volume_cmd_topic, str(volume), qos=2, expires=True, supersedes=True)
+
+    def _on_message(self, _client, _userdata, message):
+        if message.topic == self.conf.cover_topic:
+            if self.on_cover is not None:
+                self.on_cover(self.album, data=message.payload)
+            return
+
+        field = self.fields.get(message.topic)
+        if field is None:
+            return
+
+        name, codec = field
+        try:
+            value = codec.decode(message.payload)
+        except ValueError:
+            codec.reject(message)
+            return
+        if name == PLAYER.ALBUM:
+            self.album = value
+        self.on_field(name, value)
@@ -0,0 +1,106 @@
+"""Time-boxed in-process sampling profiler
+
+The profiler only exists while a profile is taken: a thread periodically
+samples the stacks of all other threads and aggregates them into collapsed
+stacks, which can be rendered as a flame graph.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from kivy import Logger
+
+
+class SamplingProfiler:
+    def __init__(self, duration=10, interval=0.005, output_dir=".", on_done=None):
+        self.duration = duration
+        self.interval = interval
+        self.output_dir = output_dir
+        self.on_done = on_done
+
+        self.stacks = Counter()
+        self.samples = 0
+        self.path = None
+
+        self._labels = dict()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="SamplingProfiler", daemon=True)
+        self._thread.start()
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+
+        end = time.monotonic() + self.duration
+        while time.monotonic() < end:
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self._sample(names.get(ident, str(ident)), frame)
+            self.samples += 1
+            time.sleep(self.interval)
+
+        self.path = self._write()
+        if self.on_done:
+            self.on_done(self)
+
+    def _sample(self, thread_name, frame):
+        labels = []
+        while frame is not None:
+            labels.append(self._label(frame.f_code))
+            frame = frame.f_back
+        labels.append(thread_name)
+        labels.reverse()
+
+        self.stacks[";".join(labels)] += 1
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = "{}:{}".format(os.path.basename(code.co_filename), code.co_name)
+            self._labels[code] = label
+        return label
+
+    def _write(self):
+        path = os.path.join(self.output_dir,
+                            "profile-{}.folded".format(datetime.now().strftime("%Y%m%d-%H%M%S")))
+        try:
+            with open(path, "w") as f:
+                for stack, count in self.stacks.most_common():
+                    f.write("{} {}\n".format(stack, count))
+        except OSError as e:
+            Logger.warning("Profiler: Cannot write profile to %s: %s", path, e)
+            return None
+
+        Logger.info("Profiler: Wrote %d samples to %s", self.samples, path)
+        return path
+
+    def summary(self, top=10):
+        """Top functions by own and by inclusive samples, as JSON"""
+        own = Counter()
+        inclusive = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")[1:]
+            if not frames:
+                continue
+            own[frames[-1]] += count
+            for label in set(frames):
+                inclusive[label] += count
+
+        total = sum(self.stacks.values()) or 1
+
+        return json.dumps({
+            "samples": self.samples,
+            "file": self.path,
+            "own": [[label, round(100 * count / total, 1)] for label, count in own.most_common(top)],
+            "inclusive": [[label, round(100 * count / total, 1)] for label, count in inclusive.most_common(top)]
+        })
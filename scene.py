@@ -0,0 +1,200 @@
+"""Scenes switch several devices with one tap
+
+All commands of a scene are published at once, the broker keeps their
+order. The scene is complete when every device has reported its new state.
+"""
+
+from time import monotonic
+
+from kivy import Logger
+from kivy.clock import Clock
+from kivy.lang import Builder
+from kivy.properties import ColorProperty, ObjectProperty, StringProperty
+from kivy.uix.relativelayout import RelativeLayout
+
+from color import RMColor
+from metrics import REGISTRY
+from store import STORE, SCENE, SHELLY, TASMOTA
+
+CONVERGENCE = REGISTRY.histogram("smartpanel_scene_convergence_seconds",
+                                 "Time from starting a scene until all devices report the new state",
+                                 buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10))
+TIMEOUTS = REGISTRY.counter("smartpanel_scene_timeouts_total",
+                            "Scenes where some devices did not report the new state in time")
+
+
+class Scene:
+    __slots__ = ("conf", "mqtt", "key", "record", "started", "waiting", "timeout_event")
+
+    def __init__(self, conf, mqttc):
+        self.conf = conf
+        self.mqtt = mqttc
+        self.key = conf.section
+        self.record = STORE.record(self.key, SCENE)
+
+        self.started = None
+        # section: action of the devices that have not reported yet
+        self.waiting = dict()
+        self.timeout_event = None
+
+    def run(self):
+        self._stop_waiting()
+        self.started = monotonic()
+
+        # observed before publishing, so that no early echo is missed
+        for action in self.conf.actions:
+            target = self._target(action)
+            if target.schema is TASMOTA:
+                target.set(TASMOTA.EXPECTED, action.on)
+            self.waiting[action.section] = action
+            STORE.observe(action.section, self._on_device)
+
+        for action in self.conf.actions:
+            for topic, payload in action.commands:
+                self.mqtt.publish(topic, payload, qos=1, expires=True, supersedes=True)
+
+        for action in self.conf.actions:
+            if action.section in self.waiting and self._matches(action, self._target(action)):
+                del self.waiting[action.section]
+                STORE.unobserve(action.section, self._on_device)
+
+        self.record.set(SCENE.STATE, "running")
+        self._check_done(monotonic())
+
+        if self.waiting:
+            self.timeout_event = Clock.schedule_once(self._on_timeout, self.conf.timeout)
+
+    def close(self):
+        self._stop_waiting()
+        STORE.remove(self.key)
+
+    @staticmethod
+    def _target(action):
+        return STORE.record(action.section, TASMOTA if action.section.startswith("Thing:") else SHELLY)
+
+    @staticmethod
+    def _matches(action, record):
+        if record.schema is TASMOTA:
+            return record.get(TASMOTA.OBSERVED) == action.on
+        return record.get(SHELLY.RELAY) == ("on" if action.on else "off")
+
+    def _on_device(self, record):
+        # called from the MQTT thread, the time of the echo is kept
+        reported = monotonic()
+        Clock.schedule_once(lambda dt: self._on_report(record, reported))
+
+    def _on_report(self, record, reported):
+        action = self.waiting.get(record.key)
+        if action is not None and self._matches(action, record):
+            del self.waiting[record.key]
+            STORE.unobserve(record.key, self._on_device)
+            self._check_done(reported)
+
+    def _check_done(self, reported):
+        if self.waiting:
+            return
+
+        duration = reported - self.started
+        CONVERGENCE.observe(duration)
+        Logger.info("Scene: %s converged on %d devices in %.0f ms",
+                    self.conf.name, len(self.conf.actions), 1000 * duration)
+
+        self._stop_waiting()
+        self.record.set(SCENE.STATE, "done")
+
+    def _on_timeout(self, _dt):
+        self.timeout_event = None
+        TIMEOUTS.inc()
+        Logger.warning("Scene: %s, no new state from %s after %.1f s",
+                       self.conf.name, ", ".join(sorted(self.waiting)), self.conf.timeout)
+
+        self._stop_waiting()
+        self.record.set(SCENE.STATE, "timeout")
+
+    def _stop_waiting(self):
+        for section in self.waiting:
+            STORE.unobserve(section, self._on_device)
+        self.waiting = dict()
+
+        if self.timeout_event is not None:
+            self.timeout_event.cancel()
+            self.timeout_event = None
+
+
+Builder.load_string("""
+<SceneButton>:
+    size: (100, 100)
+    size_hint: (None, None)
+
+    canvas:
+        Color:
+            rgba: root.state_color
+        Line:
+            rounded_rectangle: (2, 2, self.size[0]-4, self.size[1]-4, 20)
+            width: 2
+
+    Label:
+        text: root.name
+        color: root.state_color
+        font_size: 20
+        size_hint: (None, None)
+        size: (90, 90)
+        pos: (5, 5)
+        text_size: self.size
+        halign: 'center'
+        valign: 'middle'
+""")
+
+
+class SceneButton(RelativeLayout):
+    name = StringProperty("")
+    state_color = ColorProperty(RMColor.get_rgba("light blue"))
+
+    cfg = ObjectProperty(None)
+    cfg_name = StringProperty(None)
+    mqtt = ObjectProperty(None)
+    # the scene, created on setup unless it is passed in
+    device = ObjectProperty(None, allownone=True)
+
+    COLOR_MAP = {
+        None: "light blue",
+        "running": "yellow",
+        "done": "green",
+        "timeout": "red",
+    }
+
+    def __init__(self, **kwargs):
+        super(SceneButton, self).__init__(**kwargs)
+
+        self.scene = None
+        self._setup()
+
+    def _setup(self):
+        if self.cfg is None or self.cfg_name is None or self.mqtt is None:
+            return
+
+        conf = self.cfg.devices[self.cfg_name]
+        if conf.pos is not None:
+            self.pos = conf.pos
+        self.name = conf.name
+
+        self.release()
+        self.scene = self.device if self.device is not None else Scene(conf, self.mqtt)
+        STORE.observe(self.scene.key, self._on_record)
+        self._on_record(self.scene.record)
+
+    def release(self):
+        """Stop observing the scene, e.g. when the widget is taken off the screen"""
+        if self.scene is not None:
+            STORE.unobserve(self.scene.key, self._on_record)
+
+    def _on_record(self, record):
+        self.state_color = RMColor.get_rgba(SceneButton.COLOR_MAP.get(record.get(SCENE.STATE), "reboot"))
+
+    def on_touch_down(self, touch):
+        if self.collide_point(touch.pos[0], touch.pos[1]):
+            if self.scene is not None:
+                self.scene.run()
+            return True
+
+        return super(SceneButton, self).on_touch_down(touch)
@@ -0,0 +1,524 @@
+"""Typed panel configuration
+
+The configuration file is parsed and validated once. Every section becomes
+an immutable settings object with all derived values, e.g. MQTT topics,
+already computed, so that widgets do not need to parse anything at runtime.
+"""
+
+import configparser
+from typing import NamedTuple, Optional, Tuple
+
+
+class ConfigError(Exception):
+    pass
+
+
+TASMOTA_TYPES = ("TASMOTA Simple", "TASMOTA WS2812")
+
+
+MQTT_PROTOCOLS = ("3.1.1", "5")
+
+
+class MqttSettings(NamedTuple):
+    host: str
+    port: int
+    keepalive: int
+    topic: str
+    ping_interval: float
+    degraded_after: float
+    disconnected_after: float
+    ping_topic: str
+    protocol: str
+    command_expiry: int
+    outbox_size: int
+    outbox_max_age: float
+    outbox_pace: float
+    outbox_file: Optional[str]
+    profile_dir: str
+    profile_max_duration: float
+    profile_topic: str
+    profile_result_topic: str
+    alarm_topic: str
+    alarm_event_topic: str
+    consolidate: bool
+    consolidate_min: int
+
+
+class BacklightSettings(NamedTuple):
+    brightness: int
+    timeout: Optional[float]
+
+
+class WatchdogSettings(NamedTuple):
+    threshold: float
+    report_interval: float
+    report_file: Optional[str]
+
+
+class GcSettings(NamedTuple):
+    freeze: bool
+    thresholds: Tuple[int, int, int]
+    slow_pause: float
+
+
+class SoakSettings(NamedTuple):
+    # seconds of virtual time
+    duration: float
+    warmup: float
+    snapshot_interval: float
+    message_interval: float
+    page_interval: float
+    reload_interval: float
+    reconnect_interval: float
+    command_interval: float
+    speedup: float
+    # MiB
+    max_rss_growth: float
+    max_object_growth: int
+    report_file: Optional[str]
+
+
+class MetricsSettings(NamedTuple):
+    port: Optional[int]
+    address: str
+    publish_interval: Optional[float]
+    topic: str
+
+
+class OverlaySettings(NamedTuple):
+    enabled: bool
+    window: int
+
+
+class TasmotaSettings(NamedTuple):
+    section: str
+    name: str
+    type: str
+    topic: str
+    pos: Optional[Tuple[int, int]]
+    page: int
+    color_on: str
+    color_off: str
+    color_neutral: str
+    online_topic: str
+    power_topic: str
+    power_cmd_topic: str
+    power3_cmd_topic: str
+    result_topic: str
+    dimmer_cmd_topic: str
+    hue_cmd_topic: str
+    # seconds between values while dragging a slider
+    stream_interval: float
+
+
+class ShellySettings(NamedTuple):
+    section: str
+    topic: str
+    icon: str
+    pos: Optional[Tuple[int, int]]
+    page: int
+    power_window: int
+    power_interval: float
+    relay_topic: str
+    power_topic: str
+    command_topic: str
+
+
+class SceneAction(NamedTuple):
+    section: str
+    on: bool
+    # (topic, payload) in the order they must be sent
+    commands: Tuple[Tuple[str, str], ...]
+
+
+class SceneSettings(NamedTuple):
+    section: str
+    name: str
+    pos: Optional[Tuple[int, int]]
+    page: int
+    # seconds to wait for all devices to report the new state
+    timeout: float
+    actions: Tuple[SceneAction, ...]
+
+
+class FilterSettings(NamedTuple):
+    deadband: float
+    hysteresis: float
+
+
+class EnvironmentSettings(NamedTuple):
+    # either a JSON topic with paths, or one topic per value
+    topic: Optional[str]
+    temperature_path: Optional[str]
+    humidity_path: Optional[str]
+    air_quality_path: Optional[str]
+    temperature_topic: Optional[str]
+    humidity_topic: Optional[str]
+    air_quality_topic: Optional[str]
+    temperature_filter: FilterSettings
+    humidity_filter: FilterSettings
+    air_quality_filter: FilterSettings
+
+
+PLAYER_BACKENDS = ("mqtt", "mpd")
+
+
+class PlayerSettings(NamedTuple):
+    backend: str
+    mpd_host: Optional[str]
+    mpd_port: int
+    mpd_password: Optional[str]
+    marquee: bool
+    music_dir: Optional[str]
+    cover_cache_kb: int
+    # the topics are None if the mpd backend is used without a topic
+    topic: Optional[str]
+    cmd_topic: Optional[str]
+    volume_cmd_topic: Optional[str]
+    song_filter: Optional[str]
+    player_filter: Optional[str]
+    artist_topic: Optional[str]
+    album_topic: Optional[str]
+    title_topic: Optional[str]
+    state_topic: Optional[str]
+    single_topic: Optional[str]
+    volume_topic: Optional[str]
+    cover_topic: Optional[str]
+
+
+_REQUIRED = object()
+
+
+class SectionReader:
+    """Read typed values from a section, with error messages that name the section and key"""
+
+    def __init__(self, cfg, section):
+        self.cfg = cfg
+        self.section = section
+
+    def error(self, key, message):
+        return ConfigError("[{}] {}: {}".format(self.section, key, message))
+
+    def str(self, key, default=_REQUIRED):
+        value = self.cfg.get(self.section, key, fallback=None)
+        if value is None or value == "":
+            if default is _REQUIRED:
+                raise self.error(key, "missing value")
+            return default
+        return value
+
+    def _convert(self, key, default, conv, kind):
+        value = self.str(key, None)
+        if value is None:
+            if default is _REQUIRED:
+                raise self.error(key, "missing value")
+            return default
+        try:
+            return conv(value)
+        except ValueError:
+            raise self.error(key, "expected {}, got '{}'".format(kind, value)) from None
+
+    def int(self, key, default=_REQUIRED):
+        return self._convert(key, default, int, "an integer")
+
+    def float(self, key, default=_REQUIRED):
+        return self._convert(key, default, float, "a number")
+
+    def bool(self, key, default=_REQUIRED):
+        def conv(value):
+            if value.lower() not in configparser.ConfigParser.BOOLEAN_STATES:
+                raise ValueError()
+            return configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+
+        return self._convert(key, default, conv, "yes or no")
+
+    def choice(self, key, choices, default=_REQUIRED):
+        value = self.str(key, default)
+        if value not in choices:
+            raise self.error(key, "expected one of {}, got '{}'".format(", ".join(choices), value))
+        return value
+
+    def pos(self):
+        x = self.int("posX", None)
+        y = self.int("posY", None)
+        if (x is None) != (y is None):
+            raise self.error("posX" if x is None else "posY", "posX and posY must be given together")
+        return None if x is None else (x, y)
+
+
+def _mqtt(cfg):
+    r = SectionReader(cfg, "MQTT")
+    topic = r.str("topic", "")
+    ping_interval = r.float("ping_interval", 2)
+    degraded_after = r.float("degraded_after", 3 * ping_interval)
+    return MqttSettings(host=r.str("host"),
+                        port=r.int("port", 1883),
+                        keepalive=max(5, r.int("keepalive", 60)),
+                        topic=topic,
+                        ping_interval=ping_interval,
+                        degraded_after=degraded_after,
+                        disconnected_after=max(degraded_after, r.float("disconnected_after", 5 * ping_interval)),
+                        ping_topic=topic + "/ping",
+                        protocol=r.choice("protocol", MQTT_PROTOCOLS, "3.1.1"),
+                        command_expiry=max(1, r.int("command_expiry", 10)),
+                        outbox_size=max(1, r.int("outbox_size", 32)),
+                        outbox_max_age=r.float("outbox_max_age", 300),
+                        outbox_pace=r.float("outbox_pace", 0.2),
+                        outbox_file=r.str("outbox_file", None),
+                        profile_dir=r.str("profile_dir", "."),
+                        profile_max_duration=r.float("profile_max_duration", 60),
+                        profile_topic=topic + "/profile",
+                        profile_result_topic=topic + "/profile/result",
+                        alarm_topic=topic + "/alarm",
+                        alarm_event_topic=topic + "/alarm/event",
+                        consolidate=r.bool("consolidate", False),
+                        consolidate_min=max(2, r.int("consolidate_min", 2)))
+
+
+def _backlight(cfg):
+    r = SectionReader(cfg, "Backlight")
+    return BacklightSettings(brightness=min(100, r.int("brightness", 100)),
+                             timeout=r.float("timeout", None))
+
+
+def _watchdog(cfg):
+    r = SectionReader(cfg, "Watchdog")
+    return WatchdogSettings(threshold=r.float("threshold", 0.5),
+                            report_interval=r.float("report_interval", 60),
+                            report_file=r.str("report_file", None))
+
+
+def _gc(cfg):
+    r = SectionReader(cfg, "GC")
+    return GcSettings(freeze=r.bool("freeze", True),
+                      thresholds=(max(1, r.int("threshold0", 700)),
+                                  max(1, r.int("threshold1", 10)),
+                                  max(1, r.int("threshold2", 10))),
+                      slow_pause=r.float("slow_pause", 0.017))
+
+
+def _soak(cfg):
+    r = SectionReader(cfg, "Soak")
+    duration = r.float("duration", 4 * 3600)
+    return SoakSettings(duration=duration,
+                        # the baseline must be taken before the end
+                        warmup=min(r.float("warmup", 600), duration / 2),
+                        snapshot_interval=r.float("snapshot_interval", 900),
+                        message_interval=r.float("message_interval", 10),
+                        page_interval=r.float("page_interval", 120),
+                        reload_interval=r.float("reload_interval", 1800),
+                        reconnect_interval=r.float("reconnect_interval", 3600),
+                        command_interval=r.float("command_interval", 60),
+                        speedup=max(1.0, r.float("speedup", 60)),
+                        max_rss_growth=r.float("max_rss_growth", 8),
+                        max_object_growth=r.int("max_object_growth", 5000),
+                        report_file=r.str("report_file", None))
+
+
+def _metrics(cfg, mqtt):
+    r = SectionReader(cfg, "Metrics")
+    return MetricsSettings(port=r.int("port", None),
+                           address=r.str("address", "127.0.0.1"),
+                           publish_interval=r.float("publish_interval", None),
+                           topic=mqtt.topic + "/metrics")
+
+
+def _overlay(cfg):
+    r = SectionReader(cfg, "Overlay")
+    return OverlaySettings(enabled=r.bool("enabled", False),
+                           window=max(1, r.int("window", 10)))
+
+
+def tasmota_settings(cfg, section, default_on="green", default_off="red", default_neutral="grey"):
+    r = SectionReader(cfg, section)
+    tp = r.choice("type", TASMOTA_TYPES)
+    topic = r.str("topic")
+    return TasmotaSettings(section=section,
+                           name=r.str("name", section.split(":", 1)[-1]),
+                           type=tp,
+                           topic=topic,
+                           pos=r.pos(),
+                           page=r.int("page", 0),
+                           color_on=r.str("color_on", default_on),
+                           color_off=r.str("color_off", default_off),
+                           color_neutral=r.str("color_neutral", default_neutral),
+                           online_topic=topic + "/LWT",
+                           power_topic=topic + ("/POWER1" if tp == "TASMOTA WS2812" else "/POWER"),
+                           power_cmd_topic=topic + "/cmnd/Power1",
+                           power3_cmd_topic=topic + "/cmnd/Power3",
+                           result_topic=topic + "/RESULT",
+                           dimmer_cmd_topic=topic + "/cmnd/Dimmer",
+                           hue_cmd_topic=topic + "/cmnd/HSBColor1",
+                           stream_interval=1 / max(1, r.float("stream_rate", 10)))
+
+
+def shelly_settings(cfg, section):
+    r = SectionReader(cfg, section)
+    topic = r.str("topic")
+    return ShellySettings(section=section,
+                          topic=topic,
+                          icon=r.str("icon"),
+                          pos=r.pos(),
+                          page=r.int("page", 0),
+                          power_window=max(1, r.int("power_window", 5)),
+                          power_interval=r.float("power_interval", 2),
+                          relay_topic=topic + "/relay/0",
+                          power_topic=topic + "/relay/0/power",
+                          command_topic=topic + "/relay/0/command")
+
+
+def scene_settings(cfg, section, devices):
+    r = SectionReader(cfg, section)
+
+    actions = []
+    for line in r.str("set").splitlines():
+        if not line.strip():
+            continue
+
+        target, _, state = line.rpartition("=")
+        target = target.strip()
+        state = state.strip().lower()
+        conf = devices.get(target)
+        if not isinstance(conf, (TasmotaSettings, ShellySettings)):
+            raise r.error("set", "no Thing or Shelly section [{}]".format(target))
+        if state not in ("on", "off"):
+            raise r.error("set", "expected on or off for {}, got '{}'".format(target, state))
+
+        on = state == "on"
+        if isinstance(conf, TasmotaSettings):
+            commands = [(conf.power_cmd_topic, state.upper())]
+            if conf.type == "TASMOTA WS2812":
+                commands.append((conf.power3_cmd_topic, state.upper()))
+        else:
+            commands = [(conf.command_topic, state)]
+        actions.append(SceneAction(section=target, on=on, commands=tuple(commands)))
+
+    return SceneSettings(section=section,
+                         name=r.str("name", section.split(":", 1)[-1]),
+                         pos=r.pos(),
+                         page=r.int("page", 0),
+                         timeout=r.float("timeout", 10),
+                         actions=tuple(actions))
+
+
+def _environment(cfg):
+    r = SectionReader(cfg, "Environment")
+
+    def value_filter(key):
+        return FilterSettings(deadband=r.float(key + "_deadband", 0.0),
+                              hysteresis=r.float(key + "_hysteresis", 0.0))
+
+    return EnvironmentSettings(topic=r.str("topic", None),
+                               temperature_path=r.str("temperature_path", None),
+                               humidity_path=r.str("humidity_path", None),
+                               air_quality_path=r.str("air_quality_path", None),
+                               temperature_topic=r.str("temperature", None),
+                               humidity_topic=r.str("humidity", None),
+                               air_quality_topic=r.str("air_quality", None),
+                               temperature_filter=value_filter("temperature"),
+                               humidity_filter=value_filter("humidity"),
+                               air_quality_filter=value_filter("air_quality"))
+
+
+def _player(cfg):
+    r = SectionReader(cfg, "Player")
+    backend = r.choice("backend", PLAYER_BACKENDS, "mqtt")
+    topic = r.str("topic", None) if backend == "mpd" else r.str("topic")
+
+    def sub(suffix):
+        return topic + suffix if topic is not None else None
+
+    return PlayerSettings(backend=backend,
+                          mpd_host=r.str("mpd_host") if backend == "mpd" else None,
+                          mpd_port=r.int("mpd_port", 6600),
+                          mpd_password=r.str("mpd_password", None),
+                          marquee=r.bool("marquee", False),
+                          music_dir=r.str("music_dir", None),
+                          cover_cache_kb=max(0, r.int("cover_cache_kb", 1024)),
+                          topic=topic,
+                          cmd_topic=sub("/CMD"),
+                          volume_cmd_topic=sub("/CMD/volume"),
+                          song_filter=sub("/song/#"),
+                          player_filter=sub("/player/#"),
+                          artist_topic=sub("/song/artist"),
+                          album_topic=sub("/song/album"),
+                          title_topic=sub("/song/title"),
+                          state_topic=sub("/player/state"),
+                          single_topic=sub("/player/single"),
+                          volume_topic=sub("/player/volume"),
+                          cover_topic=sub("/song/cover"))
+
+
+class PanelSettings:
+    """All settings of the panel
+
+    The section settings are immutable, a reload replaces them in place so
+    that widgets holding this object see the new settings.
+    """
+
+    def __init__(self, cfg):
+        self.mqtt = _mqtt(cfg)
+        self.backlight = _backlight(cfg)
+        self.overlay = _overlay(cfg)
+        self.watchdog = _watchdog(cfg) if cfg.has_section("Watchdog") else None
+        self.gc = _gc(cfg) if cfg.has_section("GC") else None
+        self.soak = _soak(cfg) if cfg.has_section("Soak") else None
+        self.metrics = _metrics(cfg, self.mqtt) if cfg.has_section("Metrics") else None
+        self.environment = _environment(cfg) if cfg.has_section("Environment") else None
+        self.player = _player(cfg) if cfg.has_section("Player") else None
+        self.wifi_repeater = tasmota_settings(cfg, "WifiRepeater",
+                                              default_on="light blue",
+                                              default_off="grey") if cfg.has_section("WifiRepeater") else None
+
+        # Things, Shelly and scene buttons in the order of the file
+        self.devices = dict()
+        for section in cfg.sections():
+            if section.startswith("Thing:"):
+                self.devices[section] = tasmota_settings(cfg, section)
+            elif section.startswith("Shelly"):
+                self.devices[section] = shelly_settings(cfg, section)
+            elif section.startswith("Scene:"):
+                self.devices[section] = None
+
+        # scenes refer to the other devices
+        for section in self.devices:
+            if section.startswith("Scene:"):
+                self.devices[section] = scene_settings(cfg, section, self.devices)
+
+    def update(self, other):
+        """Take over the settings of another instance that are applied live
+
+        Only the devices and the WiFi repeater are copied, the other settings
+        keep their values until a restart. Returns the section names of the
+        changed devices and the attribute names of the other changed settings.
+        """
+        # in the order of the file, removed sections last
+        sections = list(other.devices) + [sec for sec in self.devices if sec not in other.devices]
+        devices = [sec for sec in sections if self.devices.get(sec) != other.devices.get(sec)]
+        self.devices = dict(other.devices)
+
+        changed = []
+        for name in ["mqtt", "backlight", "overlay", "watchdog", "gc", "soak", "metrics",
+                     "environment", "player", "wifi_repeater"]:
+            if getattr(self, name) != getattr(other, name):
+                changed.append(name)
+        if "wifi_repeater" in changed:
+            self.wifi_repeater = other.wifi_repeater
+
+        return devices, changed
+
+
+def load_settings(path):
+    """Read and validate the configuration file, raise ConfigError on any problem"""
+    # values are taken literally, a % in a password or topic is no error
+    cfg = configparser.ConfigParser(interpolation=None)
+    try:
+        if not cfg.read(path):
+            raise ConfigError("Cannot read {}".format(path))
+    except configparser.Error as e:
+        raise ConfigError(str(e)) from None
+
+    if not cfg.has_section("MQTT"):
+        raise ConfigError("Missing [MQTT] section, see smartpanel.cfg.template for an example")
+
+    return PanelSettings(cfg)
@@ -1,8 +1,13 @@
+from collections import deque
+
+from kivy.clock import Clock
 from kivy.lang import Builder
 from kivy.properties import StringProperty, ObjectProperty, ColorProperty
 from kivy.uix.button import Button
 
+from codec import FLOAT, RELAY
 from color import RMColor
+from store import STORE, SHELLY
 
 Builder.load_string("""
 <ShellyButton>:
@@ -42,6 +47,46 @@ Builder.load_string("""
 """)
 
 
+class ShellyDevice:
+    """State and commands of a Shelly relay, the state is kept in the device store"""
+    __slots__ = ("conf", "mqtt", "key", "record", "power_samples")
+
+    def __init__(self, conf, mqttc):
+        self.conf = conf
+        self.mqtt = mqttc
+        self.key = conf.section
+        self.record = STORE.record(self.key, SHELLY)
+
+        # Power readings are averaged over a window of samples
+        self.power_samples = deque(maxlen=conf.power_window)
+
+        self.mqtt.subscribe(conf.relay_topic, self._on_relay, codec=RELAY)
+        self.mqtt.subscribe(conf.power_topic, self._on_power, codec=FLOAT)
+
+    def toggle(self):
+        self.mqtt.publish(self.conf.command_topic, "toggle", expires=True, supersedes=True)
+
+    def close(self):
+        """Unsubscribe and drop the state, the device must not be used afterwards"""
+        self.mqtt.unsubscribe(self.conf.relay_topic, self._on_relay)
+        self.mqtt.unsubscribe(self.conf.power_topic, self._on_power)
+        STORE.remove(self.key)
+
+    def relay(self):
+        return self.record.get(SHELLY.RELAY)
+
+    def power(self):
+        """Average power in W, None if unknown"""
+        return self.record.get(SHELLY.POWER)
+
+    def _on_relay(self, relay):
+        self.record.set(SHELLY.RELAY, relay)
+
+    def _on_power(self, power):
+        self.power_samples.append(power)
+        self.record.set(SHELLY.POWER, round(sum(self.power_samples) / len(self.power_samples)))
+
+
 class ShellyButton(Button):
     icon_path = StringProperty("")
     state_color = ColorProperty(RMColor.get_rgba("reboot"))
@@ -50,6 +95,8 @@ class ShellyButton(Button):
     cfg = ObjectProperty(None)
     cfg_name = StringProperty(None)
     mqtt = ObjectProperty(None)
+    # device state, created on setup unless it is passed in
+    device = ObjectProperty(None, allownone=True)
 
     COLOR_MAP = {
         "unknown": "reboot",
@@ -60,6 +107,11 @@ class ShellyButton(Button):
     def __init__(self, **kwargs):
         super(Button, self).__init__(**kwargs, text="")
 
+        self.shelly = None
+        self.relay_shown = None
+        self.power_shown = None
+        self.power_trigger = None
+
         self.bind(cfg=self._setup)
         self.bind(cfg_name=self._setup)
         self.bind(mqtt=self._setup)
@@ -67,38 +119,58 @@ class ShellyButton(Button):
         self._setup(self, None)
 
     def on_press(self):
-        if self.cfg is None or self.mqtt is None or self.cfg_name is None:
+        if self.shelly is None:
             return
 
-        topic_prefix = self.cfg.get(self.cfg_name, "topic")
-        self.mqtt.publish(topic_prefix+"/relay/0/command", "toggle")
+        self.shelly.toggle()
         self.label_text = ""
+        self.power_shown = None
+        self.power_trigger()
 
     def _setup(self, _instance, _value):
         if self.cfg is None or self.mqtt is None or self.cfg_name is None:
             return
 
-        pos_x = int(self.cfg.get(self.cfg_name, "posX"))
-        pos_y = int(self.cfg.get(self.cfg_name, "posY"))
-        self.pos = (pos_x, pos_y)
+        conf = self.cfg.devices[self.cfg_name]
+        if conf.pos is not None:
+            self.pos = conf.pos
 
-        self.icon_path = self.cfg.get(self.cfg_name, "icon")
+        self.icon_path = conf.icon
 
-        topic = self.cfg.get(self.cfg_name, "topic")
+        # Refresh the power label at most once per interval
+        if self.power_trigger is not None:
+            self.power_trigger.cancel()
+        self.power_trigger = Clock.create_trigger(self._update_power_label, conf.power_interval)
 
-        self.mqtt.subscribe(topic+"/relay/0", self._on_mqtt)
-        self.mqtt.subscribe(topic+"/relay/0/power", self._on_mqtt)
+        self.release()
+        self.shelly = self.device if self.device is not None else ShellyDevice(conf, self.mqtt)
+        STORE.observe(self.shelly.key, self._on_record)
 
-    def _on_mqtt(self, _client, _userdata, message):
-        if self.cfg is None or self.mqtt is None or self.cfg_name is None:
-            return
+        self.relay_shown = None
+        self._on_record(self.shelly.record)
+        self._update_power_label(0)
+
+    def release(self):
+        """Stop observing the device, e.g. when the widget is taken off the screen"""
+        if self.shelly is not None:
+            STORE.unobserve(self.shelly.key, self._on_record)
+        if self.power_trigger is not None:
+            self.power_trigger.cancel()
 
-        topic = message.topic
-        payload = message.payload.decode("utf-8")
+    def _on_record(self, record):
+        relay = record.get(SHELLY.RELAY)
+        if relay != self.relay_shown:
+            self.relay_shown = relay
+            self.state_color = RMColor.get_rgba(ShellyButton.COLOR_MAP.get(relay, "unknown"))
 
-        topic_prefix = self.cfg.get(self.cfg_name, "topic")
-        if self.mqtt.topic_matches_sub(topic_prefix+"/relay/0", topic):
-            self.state_color = RMColor.get_rgba(ShellyButton.COLOR_MAP.get(payload, "unknown"))
+        if record.get(SHELLY.POWER) != self.power_shown:
+            self.power_trigger()
+
+    def _update_power_label(self, _dt):
+        watts = self.shelly.power()
+        if watts is None:
+            return
 
-        if self.mqtt.topic_matches_sub(topic_prefix+"/relay/0/power", topic):
-            self.label_text = "{:d} W".format(int(float(payload)))
+        if watts != self.power_shown:
+            self.power_shown = watts
+            self.label_text = "{:d} W".format(watts)
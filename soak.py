@@ -0,0 +1,567 @@
+"""Soak test: run the panel against simulated devices and watch its memory
+
+With a [Soak] section the MQTT client talks to a simulated broker instead
+of paho. The configured devices send random state changes and answer
+commands like the real ones. Virtual time runs speedup times faster than
+the wall clock, so hours of traffic, page changes, configuration reloads
+and reconnects pass in minutes.
+
+After a warm-up, tracemalloc snapshots, the RSS and the number of objects
+tracked by the garbage collector are compared with the baseline. The panel
+stops with a report of the largest growth, and exits with an error if the
+growth is beyond the configured bounds.
+
+The report also has the size the publishes of the panel would have on the
+wire with the configured MQTT protocol, and the time until their answers
+have been handled, so that 3.1.1 and 5 can be compared with two runs. The
+simulated broker is in-process, the round trip has no network delay.
+"""
+
+import gc
+import json
+import queue
+import random
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+from kivy import Logger
+from kivy.clock import Clock
+from paho.mqtt.client import MQTT_ERR_SUCCESS, MQTTMessageInfo, topic_matches_sub
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+from metrics import REGISTRY
+from settings import ShellySettings, TasmotaSettings
+from startup import rss_bytes
+
+SIMULATED = REGISTRY.counter("smartpanel_soak_messages_total",
+                             "Messages sent by the simulated devices")
+RSS = REGISTRY.gauge("smartpanel_soak_rss_bytes",
+                     "Resident set size at the last soak test snapshot")
+OBJECTS = REGISTRY.gauge("smartpanel_soak_objects",
+                         "Objects tracked by the garbage collector at the last soak test snapshot")
+PUBLISH_BYTES = REGISTRY.counter("smartpanel_soak_publish_bytes_total",
+                                 "Bytes the PUBLISH packets of the panel would take on the wire")
+ROUND_TRIP = REGISTRY.histogram("smartpanel_soak_round_trip_seconds",
+                                "Time from a publish of the panel until its answer has been handled",
+                                buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05))
+
+
+def publish_size(topic, payload, qos, properties, v5):
+    """Return the bytes of a PUBLISH packet, like paho encodes it"""
+    length = 2 + len(topic.encode("utf-8")) + len(payload)
+    if qos > 0:
+        # packet identifier
+        length += 2
+    if v5:
+        length += len(properties.pack()) if properties is not None else 1
+
+    # fixed header with the remaining length as a variable byte integer
+    size = 1 + length
+    while True:
+        size += 1
+        length //= 128
+        if not length:
+            return size
+
+
+class SimMessage:
+    __slots__ = ("topic", "payload", "qos", "retain", "local", "sent")
+
+    def __init__(self, topic, payload, qos=0, retain=False, local=False, sent=None):
+        self.topic = topic
+        self.payload = payload if isinstance(payload, bytes) else str(payload).encode("utf-8")
+        self.qos = qos
+        self.retain = retain
+        # published by the panel itself
+        self.local = local
+        # perf_counter() of the publish of the panel this message answers
+        self.sent = sent
+
+
+class SimulatedDevices:
+    """Random state changes of the configured devices and their answers to commands"""
+
+    TITLES = ["Song {}".format(i) for i in range(50)]
+    ARTISTS = ["Artist {}".format(i) for i in range(10)]
+
+    def __init__(self, cfg, seed=0):
+        self.rng = random.Random(seed)
+        # functions that return a list of (topic, payload, retain)
+        self.sources = []
+        # (topic, payload) of the toggles the panel can send
+        self.commands = []
+        # command topic: function of the payload that returns the messages
+        # of the new state, like the device would publish them
+        self.echoes = dict()
+
+        for conf in cfg.devices.values():
+            if isinstance(conf, TasmotaSettings):
+                self._add_tasmota(conf)
+            elif isinstance(conf, ShellySettings):
+                self._add_shelly(conf)
+        if cfg.wifi_repeater is not None:
+            self._add_tasmota(cfg.wifi_repeater)
+        if cfg.environment is not None:
+            self._add_environment(cfg.environment)
+        if cfg.player is not None and cfg.player.topic is not None:
+            self._add_player(cfg.player)
+
+    def random_messages(self):
+        return self.rng.choice(self.sources)() if self.sources else []
+
+    def random_command(self):
+        return self.rng.choice(self.commands) if self.commands else None
+
+    def echo(self, topic, payload):
+        answer = self.echoes.get(topic)
+        return answer(payload.decode("utf-8")) if answer is not None else []
+
+    def _on_off(self, on="ON", off="OFF"):
+        return on if self.rng.random() < 0.5 else off
+
+    @staticmethod
+    def _switch(on, command):
+        """Return the relay state after a command, queries like "?" keep it"""
+        command = command.strip().lower()
+        if command == "toggle":
+            return not on
+        if command in ("on", "off"):
+            return command == "on"
+        return on
+
+    def _add_tasmota(self, conf):
+        relay = {"on": False}
+
+        def power():
+            return "ON" if relay["on"] else "OFF"
+
+        def state():
+            if self.rng.random() < 0.05:
+                return [(conf.online_topic, self._on_off("Online", "Offline"), True)]
+            relay["on"] = self.rng.random() < 0.5
+            return [(conf.power_topic, power(), False)]
+
+        def command(payload):
+            relay["on"] = SimulatedDevices._switch(relay["on"], payload)
+            return [(conf.power_topic, power(), False),
+                    (conf.result_topic, json.dumps({"POWER1": power()}), False)]
+
+        self.sources.append(state)
+        self.commands.append((conf.power_cmd_topic, "TOGGLE"))
+        self.echoes[conf.power_cmd_topic] = command
+        self.echoes[conf.dimmer_cmd_topic] = lambda p: [(conf.result_topic, json.dumps({"Dimmer": int(p)}), False)]
+        self.echoes[conf.hue_cmd_topic] = lambda p: [(conf.result_topic, json.dumps({"HSBColor": p}), False)]
+
+    def _add_shelly(self, conf):
+        relay = {"on": False}
+
+        def state():
+            if self.rng.random() < 0.2:
+                relay["on"] = self.rng.random() < 0.5
+                return [(conf.relay_topic, "on" if relay["on"] else "off", False)]
+            return [(conf.power_topic, "{:.2f}".format(self.rng.uniform(0, 2000)), False)]
+
+        def command(payload):
+            relay["on"] = SimulatedDevices._switch(relay["on"], payload)
+            return [(conf.relay_topic, "on" if relay["on"] else "off", False)]
+
+        self.sources.append(state)
+        self.commands.append((conf.command_topic, "toggle"))
+        self.echoes[conf.command_topic] = command
+
+    def _add_environment(self, conf):
+        def reading(path, lo, hi):
+            return path, round(self.rng.uniform(lo, hi), 1)
+
+        def state():
+            if conf.topic is None:
+                readings = [reading(conf.temperature_topic, 15, 30),
+                            reading(conf.humidity_topic, 20, 80),
+                            reading(conf.air_quality_topic, 0, 5)]
+                return [(topic, value, False) for topic, value in readings if topic]
+
+            readings = [reading(conf.temperature_path, 15, 30),
+                        reading(conf.humidity_path, 20, 80),
+                        reading(conf.air_quality_path, 0, 5)]
+
+            data = dict()
+            for path, value in readings:
+                if not path:
+                    continue
+                keys = path.split(".")
+                node = data
+                for key in keys[:-1]:
+                    node = node.setdefault(key, dict())
+                node[keys[-1]] = value
+            return [(conf.topic, json.dumps(data), False)]
+
+        self.sources.append(state)
+
+    def _add_player(self, conf):
+        player = {"state": "play", "volume": 50}
+
+        def song():
+            return [(conf.artist_topic, self.rng.choice(SimulatedDevices.ARTISTS), False),
+                    (conf.album_topic, "Album", False),
+                    (conf.title_topic, self.rng.choice(SimulatedDevices.TITLES), False)]
+
+        def command(cmd):
+            if cmd == "query":
+                return song() + [(conf.state_topic, player["state"], False),
+                                 (conf.volume_topic, player["volume"], False)]
+            if cmd in ("play", "pause"):
+                player["state"] = cmd
+                return [(conf.state_topic, cmd, False)]
+            if cmd == "next":
+                return song()
+            return []
+
+        def volume(value):
+            player["volume"] = int(value)
+            return [(conf.volume_topic, value, False)]
+
+        self.sources.append(song)
+        self.echoes[conf.cmd_topic] = command
+        self.echoes[conf.volume_cmd_topic] = volume
+
+
+class SimulatedBroker:
+    """Stands in for the paho client, messages are dispatched in a network thread like paho does"""
+
+    # like the default of Mosquitto
+    TOPIC_ALIAS_MAXIMUM = 10
+
+    def __init__(self, cfg):
+        self.devices = SimulatedDevices(cfg)
+        self.v5 = cfg.mqtt.protocol == "5"
+
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_publish = None
+        self.on_message = None
+
+        # topic filter: no local
+        self.subscriptions = dict()
+        self.callbacks = dict()
+        self.retained = dict()
+        self.aliases = dict()
+        self.lock = threading.Lock()
+
+        self.errors = 0
+        self.publishes = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._mid = 0
+
+    def connect(self, _host, _port=1883, _keepalive=60):
+        pass
+
+    def loop_start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="SimulatedBroker", daemon=True)
+            self._thread.start()
+        self._queue.put(self._connected)
+
+    def loop_stop(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def socket(self):
+        return None
+
+    def reconnect(self):
+        """Drop the connection and connect again, the subscriptions are lost like with a clean session"""
+        self._queue.put(self._disconnected)
+        self._queue.put(self._connected)
+
+    def subscribe(self, topic, qos=0, options=None, properties=None):
+        with self.lock:
+            self.subscriptions[topic] = options is not None and options.noLocal
+            retained = [m for t, m in self.retained.items() if topic_matches_sub(topic, t)]
+        for message in retained:
+            self._queue.put(message)
+
+    def unsubscribe(self, topic, properties=None):
+        with self.lock:
+            self.subscriptions.pop(topic, None)
+
+    def message_callback_add(self, sub, callback):
+        with self.lock:
+            self.callbacks[sub] = callback
+
+    def message_callback_remove(self, sub):
+        with self.lock:
+            self.callbacks.pop(sub, None)
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        message = SimMessage(topic, payload, qos, retain, local=True, sent=time.perf_counter())
+        self.publishes += 1
+        PUBLISH_BYTES.inc(publish_size(topic, message.payload, qos, properties, self.v5))
+
+        alias = getattr(properties, "TopicAlias", None) if properties is not None else None
+        if alias is not None:
+            if topic:
+                self.aliases[alias] = topic
+            else:
+                topic = self.aliases[alias]
+
+        message.topic = topic
+        self._mid += 1
+        self._queue.put(message)
+        self._queue.put(lambda mid=self._mid: self.on_publish and self.on_publish(self, None, mid))
+
+        info = MQTTMessageInfo(self._mid)
+        info.rc = MQTT_ERR_SUCCESS
+        return info
+
+    def inject(self, topic, payload, retain=False, sent=None):
+        """Send a message from a simulated device"""
+        SIMULATED.inc()
+        self._queue.put(SimMessage(topic, payload, retain=retain, sent=sent))
+
+    def _connected(self):
+        properties = None
+        if self.v5:
+            properties = Properties(PacketTypes.CONNACK)
+            properties.TopicAliasMaximum = SimulatedBroker.TOPIC_ALIAS_MAXIMUM
+        if self.on_connect is not None:
+            self.on_connect(self, None, dict(), 0, properties)
+
+    def _disconnected(self):
+        with self.lock:
+            self.subscriptions = dict()
+            self.aliases = dict()
+        if self.on_disconnect is not None:
+            self.on_disconnect(self, None, 0, None)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            try:
+                if isinstance(item, SimMessage):
+                    self._deliver(item)
+                else:
+                    item()
+            except Exception:
+                # paho would lose the connection, the soak test goes on
+                self.errors += 1
+                Logger.exception("Soak: Error in an MQTT callback")
+
+    def _deliver(self, message):
+        if message.retain:
+            self.retained[message.topic] = message
+        if message.local:
+            for topic, payload, retain in self.devices.echo(message.topic, message.payload):
+                self.inject(topic, payload, retain, message.sent)
+
+        with self.lock:
+            subscribed = any(topic_matches_sub(sub, message.topic) and not (no_local and message.local)
+                             for sub, no_local in self.subscriptions.items())
+            if not subscribed:
+                return
+            callbacks = [cb for sub, cb in self.callbacks.items() if topic_matches_sub(sub, message.topic)]
+
+        if not callbacks and self.on_message is not None:
+            callbacks = [self.on_message]
+        for cb in callbacks:
+            cb(self, None, message)
+        if callbacks and message.sent is not None:
+            ROUND_TRIP.observe(time.perf_counter() - message.sent)
+
+
+class Sample:
+    __slots__ = ("virtual", "rss", "objects", "types", "snapshot")
+
+    def __init__(self, virtual, rss, objects, types, snapshot):
+        self.virtual = virtual
+        self.rss = rss
+        self.objects = objects
+        self.types = types
+        self.snapshot = snapshot
+
+
+class SoakTest:
+    # messages per frame at most, the main loop must keep up with the traffic
+    MAX_MESSAGES_PER_TICK = 200
+    TOP = 15
+
+    def __init__(self, conf, app):
+        self.conf = conf
+        self.app = app
+
+        self.virtual = 0
+        self.messages = 0
+        self._due_messages = 0
+        self._tick_event = None
+        # [virtual due time, interval, action]
+        self._actions = []
+
+        self.baseline = None
+        self.failed = False
+
+    @staticmethod
+    def from_config(cfg, app):
+        if cfg.soak is None:
+            return None
+
+        return SoakTest(cfg.soak, app)
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+        self._actions = [[self.conf.warmup, None, self._take_baseline],
+                         [self.conf.snapshot_interval, self.conf.snapshot_interval, self._log_sample],
+                         [self.conf.duration, None, self._finish]]
+        for interval, action in [(self.conf.page_interval, self._next_page),
+                                 (self.conf.reload_interval, self._reload),
+                                 (self.conf.reconnect_interval, self._reconnect),
+                                 (self.conf.command_interval, self._command)]:
+            if interval:
+                self._actions.append([interval, interval, action])
+
+        Logger.info("Soak: Running %.1f h of virtual time, %.0f times faster than real time",
+                    self.conf.duration / 3600, self.conf.speedup)
+        self._tick_event = Clock.schedule_interval(self._tick, 0)
+
+    def stop(self):
+        if self._tick_event is not None:
+            self._tick_event.cancel()
+            self._tick_event = None
+
+    def _broker(self):
+        backend = self.app.root.mqtt.backend
+        return backend if isinstance(backend, SimulatedBroker) else None
+
+    def _tick(self, dt):
+        step = dt * self.conf.speedup
+        self.virtual += step
+
+        broker = self._broker()
+        if broker is not None and broker.devices.sources:
+            self._due_messages += step * len(broker.devices.sources) / self.conf.message_interval
+            count = min(int(self._due_messages), SoakTest.MAX_MESSAGES_PER_TICK)
+            self._due_messages -= int(self._due_messages)
+            for _ in range(count):
+                for topic, payload, retain in broker.devices.random_messages():
+                    broker.inject(topic, payload, retain)
+                    self.messages += 1
+
+        for action in self._actions:
+            if action[0] is not None and self.virtual >= action[0]:
+                action[0] = self.virtual + action[1] if action[1] else None
+                action[2]()
+
+    def _next_page(self):
+        pager = self.app.root.pager
+        if pager is not None and pager.page_count > 1:
+            pager.show_page((pager.page + 1) % pager.page_count)
+
+    def _reload(self):
+        pager = self.app.root.pager
+        if pager is not None:
+            pager.reload(list(self.app.cfg.devices))
+
+    def _reconnect(self):
+        broker = self._broker()
+        if broker is not None:
+            broker.reconnect()
+
+    def _command(self):
+        """Toggle a device like a tap on its widget"""
+        broker = self._broker()
+        command = broker.devices.random_command() if broker is not None else None
+        if command is not None:
+            topic, payload = command
+            self.app.root.mqtt.publish(topic, payload, qos=2, expires=True, supersedes=True)
+
+    def _sample(self, with_snapshot):
+        gc.collect()
+        objects = gc.get_objects()
+        types = Counter(type(o).__name__ for o in objects)
+        count = len(objects) + gc.get_freeze_count()
+        del objects
+
+        snapshot = None
+        if with_snapshot:
+            # without the samples of the soak test itself
+            snapshot = tracemalloc.take_snapshot().filter_traces(
+                (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)))
+
+        sample = Sample(self.virtual, rss_bytes(), count, types, snapshot)
+        RSS.set(sample.rss)
+        OBJECTS.set(sample.objects)
+        return sample
+
+    def _take_baseline(self):
+        self.baseline = self._sample(True)
+        Logger.info("Soak: Baseline after %.1f h, RSS %.1f MiB, %d objects",
+                    self.virtual / 3600, self.baseline.rss / 2**20, self.baseline.objects)
+
+    def _log_sample(self):
+        sample = self._sample(False)
+        Logger.info("Soak: %.1f h, %d messages, RSS %.1f MiB, %d objects",
+                    self.virtual / 3600, self.messages, sample.rss / 2**20, sample.objects)
+
+    def _finish(self):
+        self.stop()
+        final = self._sample(True)
+        if self.baseline is None:
+            self.baseline = final
+
+        rss_growth = (final.rss - self.baseline.rss) / 2**20
+        object_growth = final.objects - self.baseline.objects
+        broker = self._broker()
+        errors = broker.errors if broker is not None else 0
+        self.failed = (rss_growth > self.conf.max_rss_growth
+                       or object_growth > self.conf.max_object_growth
+                       or errors > 0)
+
+        lines = ["Soak test over {:.1f} h of virtual time, {} simulated messages, {} callback errors".format(
+                     self.virtual / 3600, self.messages, errors),
+                 "RSS {:.1f} MiB -> {:.1f} MiB ({:+.1f} MiB, at most {:+.1f} MiB)".format(
+                     self.baseline.rss / 2**20, final.rss / 2**20, rss_growth, self.conf.max_rss_growth),
+                 "Objects {} -> {} ({:+d}, at most {:+d})".format(
+                     self.baseline.objects, final.objects, object_growth, self.conf.max_object_growth),
+                 "Largest growth by allocation site:"]
+        if broker is not None and broker.publishes:
+            round_trip = ROUND_TRIP.sum / ROUND_TRIP.count if ROUND_TRIP.count else 0
+            lines.insert(1, "MQTT {}: {} publishes, {:.1f} bytes per publish, answers after {:.3f} ms".format(
+                "5" if broker.v5 else "3.1.1", broker.publishes, PUBLISH_BYTES.value / broker.publishes,
+                1000 * round_trip))
+        for stat in final.snapshot.compare_to(self.baseline.snapshot, "lineno")[:SoakTest.TOP]:
+            lines.append("  {}".format(stat))
+
+        lines.append("Largest growth by type:")
+        growth = final.types.copy()
+        growth.subtract(self.baseline.types)
+        for name, count in growth.most_common(SoakTest.TOP):
+            if count <= 0:
+                break
+            lines.append("  {}: {:+d} ({})".format(name, count, final.types[name]))
+
+        lines.append("FAILED" if self.failed else "PASSED")
+        self._write("\n".join(lines))
+
+        tracemalloc.stop()
+        self.app.stop()
+
+    def _write(self, report):
+        if self.conf.report_file is not None:
+            try:
+                with open(self.conf.report_file, "w") as f:
+                    f.write(report + "\n")
+            except OSError as e:
+                Logger.warning("Soak: Cannot write report to %s: %s", self.conf.report_file, e)
+
+        log = Logger.error if self.failed else Logger.info
+        for line in report.splitlines():
+            log("Soak: %s", line)
@@ -0,0 +1,55 @@
+"""Measure the startup phases of the panel relative to the process start"""
+
+import os
+import time
+
+from kivy import Logger
+
+from metrics import REGISTRY
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def process_age():
+    """Seconds since the process has been started, 0 if unknown"""
+    try:
+        with open("/proc/self/stat") as f:
+            # the command name may contain spaces, fields are counted after it
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+
+        return max(0.0, uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK"))
+    except (OSError, IndexError, ValueError):
+        return 0.0
+
+
+def rss_bytes():
+    """Resident set size of the process, 0 if unknown"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+class StartupTimer:
+    def __init__(self):
+        self.start = time.monotonic() - process_age()
+        self.phases = []
+
+    def mark(self, phase):
+        """Record that a phase has been reached, every phase is recorded once"""
+        if any(p == phase for p, _ in self.phases):
+            return
+
+        elapsed = time.monotonic() - self.start
+        self.phases.append((phase, elapsed))
+
+        REGISTRY.gauge("smartpanel_startup_{}_seconds".format(phase),
+                       "Seconds from process start until {}".format(phase.replace("_", " "))).set(elapsed)
+
+        Logger.info("Startup: %s after %.3f s", phase.replace("_", " "), elapsed)
+
+
+STARTUP = StartupTimer()
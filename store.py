@@ -0,0 +1,114 @@
+"""Central store for device state
+
+Each device has a record with a fixed set of fields, defined by a schema.
+Setting a field to its current value is suppressed, every actual change
+increments the record's version and notifies its observers, so observers
+can skip records whose version they have already seen.
+"""
+
+import threading
+
+from metrics import REGISTRY
+
+UPDATES = REGISTRY.counter("smartpanel_store_updates_total",
+                           "Device state changes")
+SUPPRESSED = REGISTRY.counter("smartpanel_store_suppressed_total",
+                              "Device state updates that did not change the state")
+RECORDS = REGISTRY.gauge("smartpanel_store_records",
+                         "Device records in the state store")
+
+
+class Schema:
+    """Field names of a record, each field is also available as upper-case index"""
+    def __init__(self, name, *fields):
+        self.name = name
+        self.fields = fields
+        for idx, field in enumerate(fields):
+            setattr(self, field.upper(), idx)
+
+
+TASMOTA = Schema("tasmota", "online", "observed", "expected", "dimmer", "hue")
+SHELLY = Schema("shelly", "relay", "power")
+SCENE = Schema("scene", "state")
+PLAYER = Schema("player", "state", "single", "volume", "artist", "album", "title")
+
+
+class DeviceRecord:
+    __slots__ = ("key", "schema", "version", "values", "observers")
+
+    def __init__(self, key, schema):
+        self.key = key
+        self.schema = schema
+        self.version = 0
+        self.values = [None] * len(schema.fields)
+        # replaced on change, so it can be iterated without a lock
+        self.observers = ()
+
+    def get(self, field):
+        return self.values[field]
+
+    def set(self, field, value, notify=True):
+        """Set a field by index, return True if the value has changed"""
+        if self.values[field] == value:
+            SUPPRESSED.inc()
+            return False
+
+        self.values[field] = value
+        self.version += 1
+        UPDATES.inc()
+
+        if notify:
+            self.notify()
+        return True
+
+    def notify(self):
+        for cb in self.observers:
+            cb(self)
+
+    def as_dict(self):
+        return dict(zip(self.schema.fields, self.values))
+
+
+class DeviceStore:
+    def __init__(self):
+        self.records = dict()
+        self.lock = threading.Lock()
+
+    def record(self, key, schema):
+        """Get the record for a device, it is created on first access"""
+        with self.lock:
+            record = self.records.get(key)
+            if record is None:
+                record = DeviceRecord(key, schema)
+                self.records[key] = record
+                RECORDS.set(len(self.records))
+            elif record.schema is not schema:
+                raise ValueError("Record {} has schema {}, not {}".format(key, record.schema.name, schema.name))
+            return record
+
+    def remove(self, key):
+        with self.lock:
+            self.records.pop(key, None)
+            RECORDS.set(len(self.records))
+
+    def observe(self, key, cb):
+        """Call cb(record) on every change of the record, the record must exist"""
+        with self.lock:
+            record = self.records[key]
+            record.observers = record.observers + (cb,)
+
+    def unobserve(self, key, cb):
+        with self.lock:
+            record = self.records.get(key)
+            if record is not None:
+                record.observers = tuple(o for o in record.observers if o != cb)
+
+    def snapshot(self):
+        """Versions and values of all records"""
+        with self.lock:
+            records = list(self.records.values())
+
+        return {r.key: (r.version, r.as_dict()) for r in records}
+
+
+STORE = DeviceStore()
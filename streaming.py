@@ -0,0 +1,64 @@
+"""Publish values of a slider or colour wheel while it is moved"""
+
+import time
+
+from kivy.clock import Clock
+
+from metrics import REGISTRY
+
+STREAMED = REGISTRY.counter("smartpanel_mqtt_streamed_values_total",
+                            "Values sent by streaming publishers")
+COALESCED = REGISTRY.counter("smartpanel_mqtt_coalesced_values_total",
+                             "Streamed values replaced by a newer value before they were sent")
+
+
+class StreamingPublisher:
+    """Publish a stream of values to one topic at a bounded rate
+
+    Only the latest value is sent, values in between are dropped. The final
+    value is always sent, with QoS 1 as a command.
+    """
+
+    def __init__(self, mqttc, topic, interval):
+        self.mqtt = mqttc
+        self.topic = topic
+        self.interval = interval
+
+        # latest value that has not been sent yet
+        self.value = None
+        self.sent = None
+        self.sent_time = 0
+
+        self._trigger = Clock.create_trigger(self._send_latest, interval)
+
+    def send(self, value):
+        if self.value is not None:
+            COALESCED.inc()
+        self.value = value
+
+        if time.monotonic() - self.sent_time >= self.interval:
+            self._send_latest()
+        else:
+            self._trigger()
+
+    def finish(self, value):
+        self.cancel()
+        self.sent = value
+        self.sent_time = time.monotonic()
+        self.mqtt.publish(self.topic, str(value), qos=1, expires=True, supersedes=True)
+        STREAMED.inc()
+
+    def cancel(self):
+        self._trigger.cancel()
+        self.value = None
+
+    def _send_latest(self, *_args):
+        value = self.value
+        self.value = None
+        if value is None or value == self.sent:
+            return
+
+        self.sent = value
+        self.sent_time = time.monotonic()
+        self.mqtt.publish(self.topic, str(value), qos=0)
+        STREAMED.inc()
@@ -1,103 +1,101 @@
 from kivy.clock import Clock
-from time import sleep
+from time import monotonic
 
+from codec import JSON, ON_OFF, ONLINE
+from metrics import REGISTRY
+from store import STORE, TASMOTA
+from streaming import StreamingPublisher
 
-class TasmotaOnlineState(object):
-    def __init__(self, cb=None):
-        self._online = None
-        self._cb = cb
+TOGGLES = REGISTRY.counter("smartpanel_tasmota_toggles_total",
+                           "Toggle commands sent to Tasmota devices")
+TOGGLE_RTT = REGISTRY.histogram("smartpanel_tasmota_toggle_rtt_seconds",
+                                "Time from a toggle command to the power state echo",
+                                buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10))
 
-    def handle_message(self, message):
-        topic = message.topic
 
-        _old = self._online
+class TasmotaOnlineState(object):
+    __slots__ = ("_record",)
 
-        if message.payload == b'Online':
-            self._online = True
-        elif message.payload == b'Offline':
-            self._online = False
-        else:
-            self._online = None
-            print("Unknown message for topic {}: {}".format(topic, message.payload))
+    def __init__(self, record):
+        self._record = record
 
-        if self._online != _old and self._cb is not None:
-            self._cb(self)
+    def mqtt_online(self, online):
+        """Online state from the LWT, None if unknown"""
+        self._record.set(TASMOTA.ONLINE, online)
 
     def online(self):
-        return self._online
+        return self._record.get(TASMOTA.ONLINE)
 
 
 class TasmotaPowerState(object):
-    def __init__(self, cb=None):
-        self._observed = None
-        self._expected = None
-        self._cb = cb
+    __slots__ = ("_record",)
 
-    def mqtt_pwr(self, pwr):
-        _old = self._observed
+    def __init__(self, record):
+        self._record = record
 
-        self._observed = pwr
-        self._expected = pwr
+    def mqtt_pwr(self, pwr):
+        changed = self._record.set(TASMOTA.OBSERVED, pwr, notify=False)
+        changed |= self._record.set(TASMOTA.EXPECTED, pwr, notify=False)
 
-        if _old != pwr and self._cb is not None:
-            self._cb(self)
+        if changed:
+            self._record.notify()
 
     def user_pwr(self, pwr):
-        _old = self._expected
-
-        self._expected = pwr
-
-        if _old != pwr and self._cb is not None:
-            self._cb(self)
+        self._record.set(TASMOTA.EXPECTED, pwr)
 
     def user_toggle(self):
-        self.user_pwr(self._expected is not True)
+        self.user_pwr(self.expected() is not True)
 
     def expected(self):
-        return self._expected
+        return self._record.get(TASMOTA.EXPECTED)
 
     def observed(self):
-        return self._observed
+        return self._record.get(TASMOTA.OBSERVED)
 
     def observation_match(self):
-        return self._observed is not None and self._observed == self._expected
+        observed = self.observed()
+        return observed is not None and observed == self.expected()
 
-    def handle_message(self, message):
-        topic = message.topic
 
-        state = str(message.payload)[2:-1]
-        if state == "ON":
-            self.mqtt_pwr(True)
-        elif state == "OFF":
-            self.mqtt_pwr(False)
-        else:
-            self.mqtt_pwr(None)
-            print("Unknown message for topic {}: {}".format(topic, message.payload))
+class TasmotaDevice:
+    """State and commands of a Tasmota device, the state is kept in the device store
 
+    Observe the record (STORE.observe(device.key, cb)) to be notified about changes.
+    """
+    __slots__ = ("conf", "mqtt", "key", "record", "online_state", "pwr_state",
+                 "mqtt_trigger", "throttled", "toggle_sent", "dimmer_stream", "hue_stream")
 
-class TasmotaDevice:
-    def __init__(self, cfg, section, mqttc, on_state=None):
-        self.cfg = cfg
+    def __init__(self, conf, mqttc):
+        self.conf = conf
         self.mqtt = mqttc
-        self.on_state = on_state
+        self.key = conf.section
 
-        self.tp = self.cfg.get(section, "type")
-        self.topic = self.cfg.get(section, "topic")
-
-        self.online_state = TasmotaOnlineState(cb=self._on_online_state)
-        self.pwr_state = TasmotaPowerState(cb=self._on_pwr_state)
+        self.record = STORE.record(self.key, TASMOTA)
+        self.online_state = TasmotaOnlineState(self.record)
+        self.pwr_state = TasmotaPowerState(self.record)
 
         self.mqtt_trigger = Clock.create_trigger(self._mqtt_toggle)
 
-        self.mqtt.subscribe(self._get_online_topic(), self._on_online_mqtt)
-        self.mqtt.subscribe(self._get_pwr_topic(), self._on_pwr_mqtt)
+        self.mqtt.subscribe(conf.online_topic, self.online_state.mqtt_online, codec=ONLINE)
+        self.mqtt.subscribe(conf.power_topic, self._on_pwr_mqtt, codec=ON_OFF)
+
+        # dimmer and colour of LED strips, fed by the RESULT echo
+        self.dimmer_stream = None
+        self.hue_stream = None
+        if self.is_light():
+            self.dimmer_stream = StreamingPublisher(mqttc, conf.dimmer_cmd_topic, conf.stream_interval)
+            self.hue_stream = StreamingPublisher(mqttc, conf.hue_cmd_topic, conf.stream_interval)
+            self.mqtt.subscribe(conf.result_topic, self._on_result_mqtt, codec=JSON)
 
         # query the state
-        self.mqtt.publish(self.topic + "/cmnd/Power1", "?", qos=2)
+        self.mqtt.publish(conf.power_cmd_topic, "?", qos=2)
 
         # if this is active, toggle actions will be ignored
         self.throttled = False
 
+        # send time of the last toggle that has not been echoed yet
+        self.toggle_sent = None
+
     def toggle(self):
         if not self.throttled:
             self.throttled = True
@@ -106,6 +104,34 @@ class TasmotaDevice:
             self.pwr_state.user_toggle()
             self.mqtt_trigger()
 
+    def close(self):
+        """Unsubscribe and drop the state, the device must not be used afterwards"""
+        self.mqtt.unsubscribe(self.conf.online_topic, self.online_state.mqtt_online)
+        self.mqtt.unsubscribe(self.conf.power_topic, self._on_pwr_mqtt)
+        if self.is_light():
+            self.mqtt.unsubscribe(self.conf.result_topic, self._on_result_mqtt)
+            self.dimmer_stream.cancel()
+            self.hue_stream.cancel()
+        self.mqtt_trigger.cancel()
+        STORE.remove(self.key)
+
+    def is_light(self):
+        return self.conf.type == "TASMOTA WS2812"
+
+    def set_dimmer(self, dimmer, final=False):
+        """Send a dimmer value (0 to 100), a final value ends a drag"""
+        if final:
+            self.dimmer_stream.finish(dimmer)
+        else:
+            self.dimmer_stream.send(dimmer)
+
+    def set_hue(self, hue, final=False):
+        """Send a hue (0 to 360) and keep saturation and brightness, a final value ends a drag"""
+        if final:
+            self.hue_stream.finish(hue)
+        else:
+            self.hue_stream.send(hue)
+
     def _unthrottle(self, *_largs):
         self.throttled = False
 
@@ -115,31 +141,34 @@ class TasmotaDevice:
     def get_pwr_state(self):
         return self.pwr_state
 
-    def _get_online_topic(self):
-        return self.topic + "/LWT"
-
-    def _get_pwr_topic(self):
-        pwr = "/POWER1" if self.tp == "TASMOTA WS2812" else "/POWER"
-
-        return self.topic + pwr
-
     def _mqtt_toggle(self, *_largs):
-        self.mqtt.publish(self.topic + "/cmnd/Power1", "TOGGLE", qos=2)
-
-        if self.tp == "TASMOTA WS2812":
-            sleep(1)
-            self.mqtt.publish(self.topic + "/cmnd/Power3", "TOGGLE", qos=2)
-
-    def _on_online_mqtt(self, _client, _userdata, message):
-        self.online_state.handle_message(message)
-
-    def _on_pwr_mqtt(self, _client, _userdata, message):
-        self.pwr_state.handle_message(message)
-
-    def _on_online_state(self, _state):
-        if self.on_state:
-            self.on_state(self)
-
-    def _on_pwr_state(self, _state):
-        if self.on_state:
-            self.on_state(self)
+        self.mqtt.publish(self.conf.power_cmd_topic, "TOGGLE", qos=2, expires=True, supersedes=True)
+        self.toggle_sent = monotonic()
+        TOGGLES.inc()
+
+        # published back to back, the broker keeps their order
+        if self.conf.type == "TASMOTA WS2812":
+            self.mqtt.publish(self.conf.power3_cmd_topic, "TOGGLE", qos=2, expires=True, supersedes=True)
+
+    def _on_result_mqtt(self, result):
+        if not isinstance(result, dict):
+            return
+
+        changed = False
+        if isinstance(result.get("Dimmer"), int):
+            changed |= self.record.set(TASMOTA.DIMMER, result["Dimmer"], notify=False)
+        if isinstance(result.get("HSBColor"), str):
+            try:
+                changed |= self.record.set(TASMOTA.HUE, int(result["HSBColor"].split(",")[0]), notify=False)
+            except ValueError:
+                pass
+
+        if changed:
+            self.record.notify()
+
+    def _on_pwr_mqtt(self, pwr):
+        if self.toggle_sent is not None:
+            TOGGLE_RTT.observe(monotonic() - self.toggle_sent)
+            self.toggle_sent = None
+
+        self.pwr_state.mqtt_pwr(pwr)
@@ -1,9 +1,15 @@
+import colorsys
+
+from kivy.clock import Clock
 from kivy.lang import Builder
+from kivy.uix.modalview import ModalView
 from kivy.uix.relativelayout import RelativeLayout
-from kivy.properties import ListProperty, StringProperty, ObjectProperty
+from kivy.uix.slider import Slider
+from kivy.properties import ListProperty, StringProperty, ObjectProperty, NumericProperty, BooleanProperty
 
 import color
 from color import StateColor
+from store import STORE, TASMOTA
 from tasmota import TasmotaDevice
 
 
@@ -45,12 +51,19 @@ class Thing(RelativeLayout):
     cfg = ObjectProperty(None)
     cfg_name = StringProperty(None)
     mqtt = ObjectProperty(None)
+    # device state, created on setup unless it is passed in
+    device = ObjectProperty(None, allownone=True)
+
+    # seconds a light must be held to open its sliders
+    LONG_PRESS = 0.8
 
     def __init__(self, **kwargs):
         super(Thing, self).__init__(**kwargs)
 
         self.sc = None
         self.tasmota = None
+        self.version_shown = None
+        self._long_press_event = None
 
         self._setup()
 
@@ -58,29 +71,213 @@ class Thing(RelativeLayout):
         if self.cfg is None or self.cfg_name is None or self.mqtt is None:
             return
 
-        pos_x = int(self.cfg.get(self.cfg_name, "posX"))
-        pos_y = int(self.cfg.get(self.cfg_name, "posY"))
-        self.pos = (pos_x, pos_y)
+        conf = self.cfg.devices[self.cfg_name]
+        if conf.pos is not None:
+            self.pos = conf.pos
 
-        self.name = self.cfg.get(self.cfg_name, "name")
-        self.sc = StateColor(self.cfg, self.cfg_name)
+        self.name = conf.name
+        self.sc = StateColor(conf)
 
-        self.tasmota = TasmotaDevice(self.cfg, self.cfg_name, self.mqtt, on_state=self.on_state)
-        self.on_state(self.tasmota)
+        self.release()
+        self.tasmota = self.device if self.device is not None else TasmotaDevice(conf, self.mqtt)
+        STORE.observe(self.tasmota.key, self._on_record)
+        self.version_shown = None
+        self._on_record(self.tasmota.record)
+
+    def release(self):
+        """Stop observing the device, e.g. when the widget is taken off the screen"""
+        if self.tasmota is not None:
+            STORE.unobserve(self.tasmota.key, self._on_record)
+
+    def _on_record(self, record):
+        if record.version != self.version_shown:
+            self.version_shown = record.version
+            self.on_state(self.tasmota)
 
     def on_touch_down(self, touch):
         if self.collide_point(touch.pos[0], touch.pos[1]):
-            if self.tasmota.get_online_state().online():
+            if self.tasmota.is_light():
+                # toggle on release, unless it becomes a long press
+                touch.grab(self)
+                self._long_press_event = Clock.schedule_once(lambda dt: self._open_light(), Thing.LONG_PRESS)
+            elif self.tasmota.get_online_state().online():
                 self.tasmota.toggle()
 
             return True
         else:
             return super(Thing, self).on_touch_down(touch)
 
+    def on_touch_up(self, touch):
+        if touch.grab_current is not self:
+            return super(Thing, self).on_touch_up(touch)
+
+        touch.ungrab(self)
+        if self._long_press_event is not None:
+            self._long_press_event.cancel()
+            self._long_press_event = None
+            if self.tasmota.get_online_state().online():
+                self.tasmota.toggle()
+
+        return True
+
+    def _open_light(self):
+        self._long_press_event = None
+        LightPopup(device=self.tasmota, title=self.name).open()
+
     def on_state(self, state):
         self.state_color = self.sc.get(state) if self.sc is not None else color.RMColor.get_rgba("reboot")
 
 
+Builder.load_string('''
+<LightPopup>:
+    size_hint: (None, None)
+    size: (500, 260)
+    background_color: (0, 0, 0, 0.8)
+
+    RelativeLayout:
+        canvas:
+            Color:
+                rgba: root.preview_color
+            Line:
+                rounded_rectangle: (2, 2, self.size[0]-4, self.size[1]-4, 20)
+                width: 2
+            Rectangle:
+                pos: (410, 150)
+                size: (70, 70)
+
+        Label:
+            text: root.title
+            font_size: 28
+            size_hint: (None, None)
+            size: (380, 70)
+            text_size: self.size
+            pos: (20, 150)
+            valign: 'middle'
+            shorten: True
+
+        Label:
+            text: "Dimmer {:d} %".format(int(root.dimmer))
+            font_size: 18
+            size_hint: (None, None)
+            size: (460, 24)
+            text_size: self.size
+            pos: (20, 118)
+
+        ReleaseSlider:
+            size_hint: (None, None)
+            size: (460, 40)
+            pos: (20, 80)
+            min: 0
+            max: 100
+            step: 1
+            value: root.dimmer
+            on_value: root.on_dimmer_drag(self.value)
+            on_release: root.on_dimmer_release(self.value)
+
+        Label:
+            text: "Colour"
+            font_size: 18
+            size_hint: (None, None)
+            size: (460, 24)
+            text_size: self.size
+            pos: (20, 48)
+
+        ReleaseSlider:
+            size_hint: (None, None)
+            size: (460, 40)
+            pos: (20, 10)
+            min: 0
+            max: 359
+            step: 1
+            value: root.hue
+            on_value: root.on_hue_drag(self.value)
+            on_release: root.on_hue_release(self.value)
+''')
+
+
+class ReleaseSlider(Slider):
+    """Slider that dispatches on_release when the drag ends"""
+    __events__ = ('on_release',)
+
+    def on_touch_up(self, touch):
+        if touch.grab_current is self:
+            super(ReleaseSlider, self).on_touch_up(touch)
+            self.dispatch('on_release')
+            return True
+
+        return super(ReleaseSlider, self).on_touch_up(touch)
+
+    def on_release(self):
+        pass
+
+
+class LightPopup(ModalView):
+    """Dimmer and colour of a WS2812 Thing
+
+    The preview follows the sliders immediately, values reported by the
+    device are taken over whenever no slider is dragged.
+    """
+    device = ObjectProperty(None)
+    title = StringProperty("")
+
+    dimmer = NumericProperty(100)
+    hue = NumericProperty(0)
+    preview_color = ListProperty([1, 1, 1, 1])
+
+    dragging = BooleanProperty(False)
+
+    def __init__(self, **kwargs):
+        super(LightPopup, self).__init__(**kwargs)
+
+        self.bind(dimmer=self._update_preview, hue=self._update_preview)
+        STORE.observe(self.device.key, self._on_record)
+        self._on_record(self.device.record)
+        self._update_preview()
+
+    def on_dismiss(self):
+        STORE.unobserve(self.device.key, self._on_record)
+
+    def _on_record(self, record):
+        # the MQTT thread reports, the sliders live in the main thread
+        Clock.schedule_once(lambda dt: self._reconcile(record))
+
+    def _reconcile(self, record):
+        if self.dragging:
+            return
+
+        if record.get(TASMOTA.DIMMER) is not None:
+            self.dimmer = record.get(TASMOTA.DIMMER)
+        if record.get(TASMOTA.HUE) is not None:
+            self.hue = record.get(TASMOTA.HUE)
+
+    def _update_preview(self, *_args):
+        r, g, b = colorsys.hsv_to_rgb(self.hue / 360, 1, max(0.1, self.dimmer / 100))
+        self.preview_color = [r, g, b, 1]
+
+    def on_dimmer_drag(self, value):
+        # value changes from reconciling are not sent back
+        if value != self.dimmer:
+            self.dragging = True
+            self.dimmer = value
+            self.device.set_dimmer(int(value))
+
+    def on_dimmer_release(self, value):
+        self.dragging = False
+        self.dimmer = value
+        self.device.set_dimmer(int(value), final=True)
+
+    def on_hue_drag(self, value):
+        if value != self.hue:
+            self.dragging = True
+            self.hue = value
+            self.device.set_hue(int(value))
+
+    def on_hue_release(self, value):
+        self.dragging = False
+        self.hue = value
+        self.device.set_hue(int(value), final=True)
+
+
 Builder.load_string('''
 <WifiRepeater>:
     size: (100, 100)
@@ -110,18 +307,19 @@ class WifiRepeater(RelativeLayout):
     def __init__(self, cfg, mqttc, pos=(0, 0), **kwargs):
         self.cfg = cfg
 
-        section = "WifiRepeater"
+        self.sc = StateColor(cfg.wifi_repeater)
 
-        self.tasmota = TasmotaDevice(cfg, section, mqttc, on_state=self.on_state)
-
-        self.sc = StateColor(cfg, section,
-                             default_on="light blue",
-                             default_off="grey")
+        self.tasmota = TasmotaDevice(cfg.wifi_repeater, mqttc)
+        STORE.observe(self.tasmota.key, lambda record: self.on_state(self.tasmota))
         self.on_state(self.tasmota)
 
         super(WifiRepeater, self).__init__(pos=pos,
                                            **kwargs)
 
+    def release(self):
+        """Drop the device, e.g. before the widget is rebuilt"""
+        self.tasmota.close()
+
     def on_touch_down(self, touch):
         if self.collide_point(touch.pos[0], touch.pos[1]):
             self.tasmota.toggle()
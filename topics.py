@@ -0,0 +1,81 @@
+"""Local routing of MQTT messages to topic filters
+
+With consolidated subscriptions the broker only knows a few wildcard
+filters that cover all topic filters of the panel, the messages are then
+routed to the handlers here.
+"""
+
+import paho.mqtt.client as mqtt
+
+
+def is_wildcard(topic_filter):
+    return "+" in topic_filter or "#" in topic_filter
+
+
+def covering_filters(filters, min_group=2):
+    """Return a small set of filters that matches every topic of the given filters
+
+    Exact topics that differ in a single level are merged into one filter
+    with a + on that level, as long as this covers at least min_group of
+    them. The result may match topics that none of the filters match.
+    """
+    wildcards = {f for f in filters if is_wildcard(f)}
+    remaining = {f for f in filters
+                 if not is_wildcard(f) and not any(mqtt.topic_matches_sub(w, f) for w in wildcards)}
+
+    cover = set(wildcards)
+    while True:
+        candidates = dict()
+        for topic in remaining:
+            levels = topic.split("/")
+            for idx in range(len(levels)):
+                candidate = "/".join(levels[:idx] + ["+"] + levels[idx + 1:])
+                candidates.setdefault(candidate, set()).add(topic)
+
+        # the filter that covers the most topics, by name for a stable result
+        best = max(candidates.items(), key=lambda item: (len(item[1]), item[0]), default=None)
+        if best is None or len(best[1]) < min_group:
+            break
+
+        cover.add(best[0])
+        remaining -= best[1]
+
+    return cover | remaining
+
+
+class TopicRouter:
+    """Map topics to the callbacks of matching filters
+
+    Exact filters are found with a dict lookup, only wildcard filters are
+    matched one by one.
+    """
+
+    def __init__(self):
+        self.exact = dict()
+        self.wildcards = dict()
+
+    def add(self, topic_filter, cb):
+        if is_wildcard(topic_filter):
+            self.wildcards[topic_filter] = cb
+        else:
+            self.exact[topic_filter] = cb
+
+    def remove(self, topic_filter):
+        self.exact.pop(topic_filter, None)
+        self.wildcards.pop(topic_filter, None)
+
+    def route(self, topic):
+        callbacks = []
+
+        cb = self.exact.get(topic)
+        if cb is not None:
+            callbacks.append(cb)
+
+        for topic_filter, cb in self.wildcards.items():
+            if mqtt.topic_matches_sub(topic_filter, topic):
+                callbacks.append(cb)
+
+        return callbacks
+
+    def filters(self):
+        return list(self.exact) + list(self.wildcards)
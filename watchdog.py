@@ -0,0 +1,102 @@
+"""Detect stalls of the Kivy main loop and report where it got stuck"""
+
+import sys
+import threading
+import time
+import traceback
+from datetime import datetime
+
+from kivy import Logger
+from kivy.clock import Clock
+
+
+class StallWatchdog:
+    def __init__(self, threshold=0.5, report_interval=60, report_file=None):
+        self.threshold = threshold
+        self.report_interval = report_interval
+        self.report_file = report_file
+
+        # the Kivy main loop runs in the main thread
+        self.main_ident = threading.main_thread().ident
+        self.last_tick = time.monotonic()
+        self.stalls = 0
+
+        self._last_report = None
+        self._tick_event = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    @staticmethod
+    def from_config(cfg):
+        if cfg.watchdog is None:
+            return None
+
+        return StallWatchdog(threshold=cfg.watchdog.threshold,
+                             report_interval=cfg.watchdog.report_interval,
+                             report_file=cfg.watchdog.report_file)
+
+    def start(self):
+        self.last_tick = time.monotonic()
+        self._tick_event = Clock.schedule_interval(self._tick, 0)
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="StallWatchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._tick_event is not None:
+            self._tick_event.cancel()
+            self._tick_event = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _tick(self, _dt):
+        self.last_tick = time.monotonic()
+
+    def _run(self):
+        stall_start = None
+        reported = False
+
+        while not self._stopped.wait(self.threshold / 4):
+            last_tick = self.last_tick
+            silent = time.monotonic() - last_tick
+
+            if silent > self.threshold:
+                if stall_start is None:
+                    stall_start = last_tick
+                    self.stalls += 1
+                    reported = self._report_stall(silent)
+            elif stall_start is not None:
+                if reported:
+                    self._write("Main loop stall ended after {:.3f} s".format(last_tick - stall_start))
+                stall_start = None
+                reported = False
+
+    def _report_stall(self, silent):
+        now = time.monotonic()
+        if self._last_report is not None and now - self._last_report < self.report_interval:
+            return False
+        self._last_report = now
+
+        frame = sys._current_frames().get(self.main_ident)
+        stack = "".join(traceback.format_stack(frame)) if frame is not None else "<no stack>\n"
+
+        started = datetime.now().timestamp() - silent
+        self._write("Main loop stalled since {} ({:.3f} s, stall #{}), main thread stack:\n{}".format(
+            datetime.fromtimestamp(started).isoformat(timespec="milliseconds"),
+            silent, self.stalls, stack))
+
+        return True
+
+    def _write(self, report):
+        if self.report_file is None:
+            Logger.warning("Watchdog: %s", report)
+            return
+
+        try:
+            with open(self.report_file, "a") as f:
+                f.write("{} {}\n".format(datetime.now().isoformat(timespec="milliseconds"), report))
+        except OSError as e:
+            Logger.warning("Watchdog: Cannot write report to %s: %s", self.report_file, e)